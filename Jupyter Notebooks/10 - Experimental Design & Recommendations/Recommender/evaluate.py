@@ -0,0 +1,117 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import recommender as r
+
+# -----------------------------
+# Define command line Arguments
+# -----------------------------
+parser = argparse.ArgumentParser(description='Offline evaluation of the FunkSVD Recommender')
+parser.add_argument('--reviews', type=str, default='train_data.csv', help='csv with user_id, movie_id, rating, timestamp and date')
+parser.add_argument('--movies', type=str, default='movies_clean.csv', help='csv with the movies information')
+parser.add_argument('--valid', type=str, help='csv of validation reviews; if not given, --valid_split of --reviews is held out')
+parser.add_argument('--valid_split', type=float, default=0.2, help='fraction of the reviews held out for validation')
+parser.add_argument('--split', type=str, default='time', choices=['time', 'random'], help='hold out the latest reviews, or random ones')
+parser.add_argument('--k', type=int, default=10, help='cut-off for precision@K, recall@K and NDCG@K')
+parser.add_argument('--relevant', type=float, default=7, help='validation ratings at or above this are relevant movies')
+parser.add_argument('--latent_features', type=int, default=12, help='Number of latent features')
+parser.add_argument('--learning_rate', type=float, default=0.005, help='Learning rate')
+parser.add_argument('--iters', type=int, default=20, help='Number of iterations')
+parser.add_argument('--n_jobs', type=int, default=1, help='Number of processes used to fit')
+
+
+def split_reviews(reviews, valid_split, split='time', seed=42):
+    '''
+    INPUT:
+    reviews - dataframe of reviews
+    valid_split - (float) fraction of the reviews to hold out
+    split - "time" holds out the latest reviews, "random" a random sample
+    seed - (int) seed for the random split
+
+    OUTPUT:
+    train - dataframe of the training reviews
+    valid - dataframe of the held out reviews
+    '''
+    if split == 'time':
+        reviews = reviews.sort_values('timestamp', kind='mergesort')
+    else:
+        reviews = reviews.sample(frac=1, random_state=seed)
+    n_train = int(len(reviews) * (1 - valid_split))
+
+    return reviews.iloc[:n_train], reviews.iloc[n_train:]
+
+
+def ranking_metrics(recs, relevant, k):
+    '''
+    INPUT:
+    recs - (dict) user_id -> array of recommended movie ids, best first
+    relevant - (dict) user_id -> set of relevant movie ids in the validation data
+    k - (int) the cut-off
+
+    OUTPUT:
+    metrics - (dict) mean precision@k, recall@k and NDCG@k over the users with relevant movies
+    '''
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    precision, recall, ndcg = [], [], []
+    for user_id, movies in relevant.items():
+        hits = np.array([movie_id in movies for movie_id in recs.get(user_id, [])[:k]], dtype=float)
+        precision.append(hits.sum() / k)
+        recall.append(hits.sum() / len(movies))
+        ndcg.append(np.dot(hits, discounts[:len(hits)]) / discounts[:min(len(movies), k)].sum())
+
+    return {'precision@%d' % k: np.mean(precision), 'recall@%d' % k: np.mean(recall), 'ndcg@%d' % k: np.mean(ndcg)}
+
+
+def evaluate(args):
+    '''
+    INPUT:
+    args - the parsed command line arguments
+
+    OUTPUT:
+    results - (dict) rating errors, ranking metrics and wall-clock times
+    '''
+    reviews = pd.read_csv(args.reviews)
+    if args.valid:
+        train, valid = reviews, pd.read_csv(args.valid)
+    else:
+        train, valid = split_reviews(reviews, args.valid_split, args.split)
+    results = {'train_reviews': len(train), 'valid_reviews': len(valid)}
+
+    # Fit
+    rec = r.Recommender()
+    start = time.time()
+    rec.fit(train, args.movies, latent_features=args.latent_features, learning_rate=args.learning_rate,
+            iters=args.iters, n_jobs=args.n_jobs)
+    results['fit_seconds'] = time.time() - start
+
+    # Predict every validation pair in one batch
+    start = time.time()
+    preds = rec.predict_ratings(valid['user_id'], valid['movie_id'])
+    results['predict_seconds'] = time.time() - start
+
+    known = ~np.isnan(preds)
+    errors = np.array(valid['rating'])[known] - preds[known]
+    results['coverage'] = known.mean()
+    results['rmse'] = np.sqrt(np.mean(errors**2))
+    results['mae'] = np.mean(np.abs(errors))
+
+    # Recommend for every validation user that we know, in batches
+    relevant = valid[valid['rating'] >= args.relevant].groupby('user_id')['movie_id'].apply(set)
+    relevant = {user_id: movies for user_id, movies in relevant.items() if user_id in rec.user_ids_series}
+    start = time.time()
+    recs = rec.recommend_users(list(relevant.keys()), args.k)
+    results['recommend_seconds'] = time.time() - start
+    results['recommend_users'] = len(relevant)
+    results.update(ranking_metrics(recs, relevant, args.k))
+
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print('args: {}'.format(args))
+
+    results = evaluate(args)
+    for name, value in results.items():
+        print('{:<20} {}'.format(name, round(value, 4) if isinstance(value, float) else value))
@@ -1,8 +1,18 @@
+import json
+import os
 import numpy as np
 import pandas as pd
 import recommender_functions as rf
 import sys # can use sys to take command line arguments
 
+# attributes written by Recommender.save as one .npy file each
+MODEL_ARRAYS = ['user_mat', 'movie_mat', 'user_ids_series', 'movie_ids_series', 'user_sorter', 'movie_sorter',
+                'rating_rows', 'rating_cols', 'rating_vals', 'seen_indptr', 'seen_cols', 'content_mat']
+MODEL_SCALARS = ['n_users', 'n_movies', 'num_ratings', 'latent_features', 'learning_rate', 'iters']
+# dataframes written by Recommender.save as one .npy file per column
+MODEL_FRAMES = ['movies', 'movie_stats', 'ranked_movies']
+MOVIE_COLUMNS = ['movie_id', 'movie', 'genre', 'date']
+
 class Recommender():
     '''
     This Recommender uses FunkSVD to make predictions of exact ratings.  And uses either FunkSVD or a Knowledge Based recommendation (highest ranked) to make recommendations for users.  Finally, if given a movie, the recommender will provide movies that are most similar as a Content Based Recommender.
@@ -13,37 +23,64 @@ class Recommender():
         '''
 
 
-    def fit(self, reviews_pth, movies_pth, latent_features=12, learning_rate=0.0001, iters=100):
+    def fit(self, reviews_pth, movies_pth, latent_features=12, learning_rate=0.0001, iters=100,
+            validation_split=0.0, patience=None, min_delta=0.0, lr_decay=1.0, tol=None, n_jobs=1, chunksize=None):
         '''
         This function performs matrix factorization using a basic form of FunkSVD with no regularization
 
         INPUT:
-        reviews_pth - path to csv with at least the four columns: 'user_id', 'movie_id', 'rating', 'timestamp'
+        reviews_pth - path to csv with at least the four columns: 'user_id', 'movie_id', 'rating', 'date',
+                      or a dataframe, or an iterator of dataframes (chunks) with these columns
         movies_pth - path to csv with each movie and movie information in each row
         latent_features - (int) the number of latent features used
         learning_rate - (float) the learning rate
-        iters - (int) the number of iterations
+        iters - (int) the maximum number of iterations
+        validation_split - (float) fraction of the ratings held out to measure the validation RMSE
+        patience - (int) stop once the validation RMSE hasn't improved for this many iterations,
+                   and keep the factors from the best iteration (needs validation_split > 0)
+        min_delta - (float) smallest drop in validation RMSE that counts as an improvement
+        lr_decay - (float) the learning rate is multiplied by this after every iteration
+        tol - (float) without a validation set, stop once the training sse changes by less than
+              this fraction of the previous iteration's sse
+        n_jobs - (int) the number of processes for gradient descent, see rf.ParallelSGD
+        chunksize - (int) read the reviews csv this many rows at a time, so only the rating triples
+                    are ever held in memory and never the whole reviews dataframe
 
         OUTPUT:
-        None - stores the following as attributes:
+        history - a list with one dict per iteration: 'iteration', 'learning_rate', 'train_mse'
+                  and 'valid_rmse' if there is a validation set
+        Also stores the following as attributes:
         n_users - the number of users (int)
         n_movies - the number of movies (int)
         num_ratings - the number of ratings made (int)
-        reviews - dataframe with four columns: 'user_id', 'movie_id', 'rating', 'timestamp'
-        movies - dataframe of
-        user_item_mat - (np array) a user by item numpy array with ratings and nans for values
+        movies - dataframe with the 'movie_id', 'movie' title, 'genre' and 'date' of every movie
+        movie_stats - dataframe of the rating sum, count and last date of each movie (see rf.create_movie_stats)
+        ranked_movies - dataframe of the movies ranked for popular recommendations (see rf.create_ranked_df)
+        ranked_titles - (np array) the titles of ranked_movies, best first
         latent_features - (int) the number of latent features used
         learning_rate - (float) the learning rate
         iters - (int) the number of iterations
+        history - the training history returned by fit
+        rating_rows, rating_cols, rating_vals - (np array) the user row, movie column and value of each rating
+        seen_indptr, seen_cols - (np array) the movie columns rated by each user row (see rf.create_seen_index)
+        content_mat - (np array) bit-packed content features of every movie (see rf.create_content_matrix)
+        lsh_index - (dict) approximate nearest neighbour index on the movie_mat columns (see rf.create_lsh_index)
         '''
-        # Store inputs as attributes
-        self.reviews = pd.read_csv(reviews_pth)
-        self.movies = pd.read_csv(movies_pth)
+        # Read in the datasets - the reviews as a stream of narrow chunks
+        if isinstance(reviews_pth, pd.DataFrame):
+            review_chunks = [reviews_pth]
+        elif isinstance(reviews_pth, str):
+            review_chunks = pd.read_csv(reviews_pth, usecols=rf.REVIEW_DTYPES.keys(), dtype=rf.REVIEW_DTYPES, chunksize=chunksize)
+            if chunksize is None:
+                review_chunks = [review_chunks]
+        else:
+            review_chunks = reviews_pth
+        movies = pd.read_csv(movies_pth)
 
-        # Create user-item matrix
-        usr_itm = self.reviews[['user_id', 'movie_id', 'rating', 'timestamp']]
-        self.user_item_df = usr_itm.groupby(['user_id','movie_id'])['rating'].max().unstack()
-        self.user_item_mat= np.array(self.user_item_df)
+        # Sparse (user row, movie column, rating) triples of the ratings, in user then movie order,
+        # along with the per movie statistics for the knowledge based fit
+        (self.user_ids_series, self.movie_ids_series, self.rating_rows, self.rating_cols, self.rating_vals,
+         self.movie_stats) = rf.create_rating_triples(review_chunks)
 
         # Store more inputs
         self.latent_features = latent_features
@@ -51,59 +88,333 @@ class Recommender():
         self.iters = iters
 
         # Set up useful values to be used through the rest of the function
-        self.n_users = self.user_item_mat.shape[0]
-        self.n_movies = self.user_item_mat.shape[1]
-        self.num_ratings = np.count_nonzero(~np.isnan(self.user_item_mat))
-        self.user_ids_series = np.array(self.user_item_df.index)
-        self.movie_ids_series = np.array(self.user_item_df.columns)
+        self.n_users = len(self.user_ids_series)
+        self.n_movies = len(self.movie_ids_series)
+        self.num_ratings = len(self.rating_vals)
+        train = np.nonzero(self.rating_vals > 0)[0]
 
         # initialize the user and movie matrices with random values
         user_mat = np.random.rand(self.n_users, self.latent_features)
         movie_mat = np.random.rand(self.latent_features, self.n_movies)
 
+        # hold out some of the ratings, they are only used to measure the validation error
+        valid = train[:0]
+        if validation_split > 0:
+            shuffled = np.random.permutation(train)
+            n_valid = int(len(train) * validation_split)
+            valid, train = np.sort(shuffled[:n_valid]), np.sort(shuffled[n_valid:])
+
+        # with several jobs the factors live in shared memory and the ratings are split in blocks
+        if n_jobs > 1:
+            parallel_sgd = rf.ParallelSGD(user_mat, movie_mat, self.rating_rows[train], self.rating_cols[train],
+                                          self.rating_vals[train], n_jobs)
+            user_mat, movie_mat = parallel_sgd.user_mat, parallel_sgd.movie_mat
+
         # initialize sse at 0 for first iteration
         sse_accum = 0
+        learning_rate = self.learning_rate
+        best_rmse, best_iteration, best_mats = np.inf, 0, None
+        self.history = []
 
         # keep track of iteration and MSE
         print("Optimizaiton Statistics")
-        print("Iterations | Mean Squared Error ")
+        print("Iterations | Mean Squared Error " + ("| Validation RMSE" if len(valid) else ""))
 
         # for each iteration
         for iteration in range(self.iters):
 
             # update our sse
             old_sse = sse_accum
-            sse_accum = 0
 
-            # For each user-movie pair
-            for i in range(self.n_users):
-                for j in range(self.n_movies):
-
-                    # if the rating exists
-                    if self.user_item_mat[i, j] > 0:
-
-                        # compute the error as the actual minus the dot product of the user and movie latent features
-                        diff = self.user_item_mat[i, j] - np.dot(user_mat[i, :], movie_mat[:, j])
-
-                        # Keep track of the sum of squared errors for the matrix
-                        sse_accum += diff**2
+            # For each user-movie pair with a rating
+            if n_jobs > 1:
+                sse_accum = parallel_sgd.epoch(learning_rate)
+            else:
+                sse_accum = rf.sgd_epoch(user_mat, movie_mat, self.rating_rows[train], self.rating_cols[train],
+                                         self.rating_vals[train], learning_rate)
 
-                        # update the values in each matrix in the direction of the gradient
-                        for k in range(self.latent_features):
-                            user_mat[i, k] += self.learning_rate * (2*diff*movie_mat[k, j])
-                            movie_mat[k, j] += self.learning_rate * (2*diff*user_mat[i, k])
+            record = {'iteration': iteration+1, 'learning_rate': learning_rate, 'train_mse': sse_accum / len(train)}
+            if len(valid):
+                errors = rf.rating_errors(user_mat, movie_mat, self.rating_rows[valid], self.rating_cols[valid],
+                                          self.rating_vals[valid])
+                record['valid_rmse'] = np.sqrt(np.mean(errors**2))
+            self.history.append(record)
 
             # print results
             if (iteration%10 == 0):
-                print("%d \t\t %f" % (iteration+1, sse_accum / self.num_ratings))
+                print("%d \t\t %f" % (iteration+1, record['train_mse']) +
+                      (" \t\t %f" % record['valid_rmse'] if len(valid) else ""))
+
+            # stop when the validation error stops improving, or without one when the sse stops moving
+            if len(valid):
+                if record['valid_rmse'] < best_rmse - min_delta:
+                    best_rmse, best_iteration = record['valid_rmse'], iteration+1
+                    if patience:
+                        best_mats = (user_mat.copy(), movie_mat.copy())
+                elif patience and iteration+1 - best_iteration >= patience:
+                    print("Stopping at iteration %d, best validation RMSE %f at iteration %d" % (iteration+1, best_rmse, best_iteration))
+                    break
+            elif tol and iteration > 0 and abs(old_sse - sse_accum) <= tol * old_sse:
+                print("Stopping at iteration %d, the sse changed by less than %g" % (iteration+1, tol))
+                break
+
+            learning_rate *= lr_decay
+
+        if n_jobs > 1:
+            parallel_sgd.close()
+            user_mat, movie_mat = user_mat.copy(), movie_mat.copy()
+
+        if best_mats is not None:
+            user_mat, movie_mat = best_mats
 
         # SVD based fit
         # Keep user_mat and movie_mat for safe keeping
         self.user_mat = user_mat
         self.movie_mat = movie_mat
 
+        # Sparse index of the rated movies, used to filter out movies a user has already seen
+        self._index_ratings()
+
+        # Content based fit - only the descriptive columns are kept next to the content matrix
+        self.content_mat = rf.create_content_matrix(movies)
+        self.movies = movies[MOVIE_COLUMNS]
+
         # Knowledge based fit
-        self.ranked_movies = rf.create_ranked_df(self.movies, self.reviews)
+        self._rank_movies()
+
+        # Item to item fit on the latent movie factors
+        self.lsh_index = rf.create_lsh_index(self.movie_mat)
+
+        return self.history
+
+
+    def _index_ratings(self):
+        '''
+        Rebuilds the lookups that depend on the rating triples and the id arrays:
+        the seen movies of each user and the sorters used to find user and movie ids
+        '''
+        self.seen_indptr, self.seen_cols = rf.create_seen_index(self.rating_rows, self.rating_cols, self.n_users)
+        self.user_sorter = np.argsort(self.user_ids_series, kind='mergesort')
+        self.movie_sorter = np.argsort(self.movie_ids_series, kind='mergesort')
+
+
+    def _rank_movies(self):
+        '''
+        Ranks the movies from movie_stats and caches the ranked titles for popular recommendations
+        '''
+        ranked_movies = rf.create_ranked_df(self.movies, movie_stats=self.movie_stats)
+        # the placeholder movies of partial_fit have no title to recommend
+        self.ranked_movies = ranked_movies[ranked_movies['movie'].notnull()]
+        self.ranked_titles = np.array(self.ranked_movies['movie'], dtype=str)
+
+
+    def partial_fit(self, new_ratings, iters=5, learning_rate=None, reg=0.1):
+        '''
+        Folds new ratings, users and movies into a fitted model without a full refit
+
+        INPUT:
+        new_ratings - dataframe (or path to csv) with at least the columns 'user_id', 'movie_id', 'rating',
+                      and 'date' to also update the popular movie ranking
+        iters - (int) the number of warm-started gradient descent passes over the affected ratings
+        learning_rate - (float) the learning rate, defaults to the one used by fit
+        reg - (float) ridge penalty used when solving for the factors of new users and movies
+
+        OUTPUT:
+        None - updates user_mat, movie_mat, the id arrays, the rating triples and the indexes built on them
+        '''
+        if isinstance(new_ratings, str):
+            new_ratings = pd.read_csv(new_ratings)
+        if learning_rate is None:
+            learning_rate = self.learning_rate
+
+        # Same rule as fit for a user rating a movie more than once
+        has_dates = 'date' in new_ratings.columns
+        new_ratings = new_ratings.groupby(['user_id', 'movie_id']).agg(
+            {'rating': 'max', 'date': 'max'} if has_dates else {'rating': 'max'}).reset_index()
+
+        # Append users and movies we haven't seen yet, starting from random values like fit
+        new_user_ids = np.setdiff1d(new_ratings['user_id'].unique(), self.user_ids_series)
+        new_movie_ids = np.setdiff1d(new_ratings['movie_id'].unique(), self.movie_ids_series)
+        n_old_users, n_old_movies = self.n_users, self.n_movies
+
+        self.user_ids_series = np.concatenate([self.user_ids_series, new_user_ids])
+        self.movie_ids_series = np.concatenate([self.movie_ids_series, new_movie_ids])
+        self.n_users, self.n_movies = len(self.user_ids_series), len(self.movie_ids_series)
+        self.user_sorter = np.argsort(self.user_ids_series, kind='mergesort')
+        self.movie_sorter = np.argsort(self.movie_ids_series, kind='mergesort')
+
+        # new arrays, so a memory-mapped model becomes writable
+        user_mat = np.vstack([self.user_mat, np.random.rand(len(new_user_ids), self.latent_features)])
+        movie_mat = np.hstack([self.movie_mat, np.random.rand(self.latent_features, len(new_movie_ids))])
+
+        # Movies missing from the movies data get a placeholder row without a title or content,
+        # so the names stay aligned with the ids in recommendations
+        unknown_movie_ids = np.setdiff1d(new_movie_ids, self.movies['movie_id'])
+        if len(unknown_movie_ids):
+            self.movies = pd.concat([self.movies, pd.DataFrame({'movie_id': unknown_movie_ids})], ignore_index=True)
+            self.content_mat = np.vstack([self.content_mat, np.zeros((len(unknown_movie_ids), self.content_mat.shape[1]),
+                                                                     dtype=self.content_mat.dtype)])
+
+        # Merge the triples; a new rating replaces an older one for the same user-movie pair
+        rows = rf.find_index(self.user_ids_series, self.user_sorter, new_ratings['user_id'])
+        cols = rf.find_index(self.movie_ids_series, self.movie_sorter, new_ratings['movie_id'])
+        all_rows = np.concatenate([self.rating_rows, rows])
+        all_cols = np.concatenate([self.rating_cols, cols])
+        all_vals = np.concatenate([self.rating_vals, np.array(new_ratings['rating'], dtype=float)])
+
+        keys = all_rows.astype(np.int64) * self.n_movies + all_cols
+        _, last = np.unique(keys[::-1], return_index=True)
+        keep = len(keys) - 1 - last
+
+        # Knowledge based update - only the new reviews are aggregated, and a replaced rating is taken out again
+        if has_dates:
+            old_keys = keys[:len(self.rating_vals)]
+            replaced_pos = rf.find_index(old_keys, np.argsort(old_keys, kind='mergesort'), keys[len(self.rating_vals):])
+            replaced = np.where(replaced_pos >= 0, self.rating_vals[replaced_pos], np.nan)
+            self.movie_stats = rf.update_movie_stats(self.movie_stats, new_ratings, replaced)
+
+        self.rating_rows, self.rating_cols, self.rating_vals = all_rows[keep], all_cols[keep], all_vals[keep]
+        self.num_ratings = len(self.rating_vals)
+        self._index_ratings()
+        if has_dates:
+            self._rank_movies()
+
+        # Solve each new user against the fixed movie factors, then each new movie against the user factors.
+        # The triples are sorted by user, so seen_indptr also slices out each user's ratings.
+        train = self.rating_vals > 0
+        for i in range(n_old_users, self.n_users):
+            rated = np.arange(self.seen_indptr[i], self.seen_indptr[i + 1])
+            rated = rated[train[rated] & (self.rating_cols[rated] < n_old_movies)]
+            if len(rated):
+                user_mat[i, :] = rf.solve_factors(movie_mat[:, self.rating_cols[rated]], self.rating_vals[rated], reg)
+
+        new_movie_pos = np.nonzero(train & (self.rating_cols >= n_old_movies))[0]
+        new_movie_pos = new_movie_pos[np.argsort(self.rating_cols[new_movie_pos], kind='mergesort')]
+        for rated in np.split(new_movie_pos, np.nonzero(np.diff(self.rating_cols[new_movie_pos]))[0] + 1):
+            if len(rated):
+                movie_mat[:, self.rating_cols[rated[0]]] = rf.solve_factors(user_mat[self.rating_rows[rated], :].T,
+                                                                            self.rating_vals[rated], reg)
+
+        # A few passes of gradient descent over only the ratings of the affected users and movies
+        affected = train & (np.isin(self.rating_rows, np.unique(rows)) | (self.rating_cols >= n_old_movies))
+        print("Fold-in Statistics")
+        print("Iterations | Mean Squared Error ")
+        for iteration in range(iters):
+            sse_accum = rf.sgd_epoch(user_mat, movie_mat, self.rating_rows[affected], self.rating_cols[affected],
+                                     self.rating_vals[affected], learning_rate)
+            print("%d \t\t %f" % (iteration+1, sse_accum / max(affected.sum(), 1)))
+
+        self.user_mat = user_mat
+        self.movie_mat = movie_mat
+
+        # The movie factors moved, so rebuild the item to item index
+        self.lsh_index = rf.create_lsh_index(self.movie_mat)
+
+
+    def save(self, path):
+        '''
+        INPUT:
+        path - directory to write the fitted model to, created if needed
+
+        OUTPUT:
+        None - writes one uncompressed .npy file per numeric array, so the model can be memory-mapped
+               by Recommender.load, each string array as a UTF-8 blob, its offsets and its missing values,
+               and the scalar attributes to model.json
+        '''
+        os.makedirs(path, exist_ok=True)
+
+        arrays = {name: getattr(self, name) for name in MODEL_ARRAYS}
+        arrays.update({'lsh_' + key: value for key, value in self.lsh_index.items()})
+        arrays['ranked_titles'] = self.ranked_titles
+
+        frames = {}
+        for name in MODEL_FRAMES:
+            frame = getattr(self, name)
+            frames[name] = {'index': frame.index.name, 'columns': list(frame.columns)}
+            arrays[name + '__index'] = np.asarray(frame.index)    # always written, named or not
+            for col in frame.columns:
+                values = frame[col]
+                if not pd.api.types.is_numeric_dtype(values):
+                    values = np.array(values.astype(str).where(values.notnull(), None), dtype=object)
+                arrays[name + '_' + col] = np.array(values)
+
+        # A fixed width unicode array takes 4 bytes per character of its longest string,
+        # so the strings are written as their UTF-8 bytes, offsets and missing value mask instead
+        strings = []
+        for name, value in arrays.items():
+            if value.dtype.kind in 'OU':
+                blob, offsets, nulls = rf.encode_strings(value)
+                np.save(os.path.join(path, name + '.npy'), blob)
+                np.save(os.path.join(path, name + '_offsets.npy'), offsets)
+                np.save(os.path.join(path, name + '_nulls.npy'), nulls)
+                strings.append(name)
+            else:
+                np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(value))
+
+        with open(os.path.join(path, 'model.json'), 'w') as f:
+            json.dump({'scalars': {name: getattr(self, name) for name in MODEL_SCALARS},
+                       'lsh_keys': sorted(self.lsh_index.keys()),
+                       'frames': frames,
+                       'strings': strings}, f, default=lambda x: x.item())
+
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        INPUT:
+        path - directory written by Recommender.save
+        mmap - (bool) memory-map the numeric arrays read-only instead of reading them into memory,
+               so several serving processes share the same pages; the strings are always decoded
+
+        OUTPUT:
+        rec - a fitted Recommender, ready for predictions and recommendations
+        '''
+        with open(os.path.join(path, 'model.json')) as f:
+            meta = json.load(f)
+        strings = set(meta['strings'])
+
+        def load_array(name):
+            if name in strings:
+                return rf.decode_strings(np.load(os.path.join(path, name + '.npy')),
+                                         np.load(os.path.join(path, name + '_offsets.npy')),
+                                         np.load(os.path.join(path, name + '_nulls.npy')))
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+
+        rec = cls()
+        for name, value in meta['scalars'].items():
+            setattr(rec, name, value)
+        for name in MODEL_ARRAYS:
+            setattr(rec, name, load_array(name))
+        rec.lsh_index = {key: load_array('lsh_' + key) for key in meta['lsh_keys']}
+
+        rec.ranked_titles = load_array('ranked_titles')
+
+        for name, frame in meta['frames'].items():
+            index = pd.Index(load_array(name + '__index'), name=frame['index'])
+            df = pd.DataFrame({col: load_array(name + '_' + col) for col in frame['columns']}, columns=frame['columns'])
+            setattr(rec, name, df.set_index(index))
+
+        return rec
+
+
+    def predict_ratings(self, user_ids, movie_ids):
+        '''
+        INPUT:
+        user_ids - a list or array of user ids
+        movie_ids - a list or array of movie ids, one for each user id
+
+        OUTPUT:
+        preds - (np array) the predicted rating of each user-movie pair according to FunkSVD,
+                nan where the user or the movie is not in the matrix factorization data
+        '''
+        rows = rf.find_index(self.user_ids_series, self.user_sorter, user_ids)
+        cols = rf.find_index(self.movie_ids_series, self.movie_sorter, movie_ids)
+        known = (rows >= 0) & (cols >= 0)
+
+        preds = np.full(len(rows), np.nan)
+        preds[known] = np.einsum('ij,ji->i', self.user_mat[rows[known], :], self.movie_mat[:, cols[known]])
+
+        return preds
 
 
     def predict_rating(self, user_id, movie_id):
@@ -118,27 +429,84 @@ class Recommender():
         try:# User row and Movie Column
             user_row = np.where(self.user_ids_series == user_id)[0][0]
             movie_col = np.where(self.movie_ids_series == movie_id)[0][0]
+        except IndexError:
+            print("I'm sorry, but a prediction cannot be made for this user-movie pair.  It looks like one of these items does not exist in our current database.")
 
-            # Take dot product of that row and column in U and V to make prediction
-            pred = np.dot(self.user_mat[user_row, :], self.movie_mat[:, movie_col])
+            return None
 
-            movie_name = str(self.movies[self.movies['movie_id'] == movie_id]['movie']) [5:]
-            movie_name = movie_name.replace('\nName: movie, dtype: object', '')
-            print("For user {} we predict a {} rating for the movie {}.".format(user_id, round(pred, 2), str(movie_name)))
+        # Take dot product of that row and column in U and V to make prediction
+        pred = np.dot(self.user_mat[user_row, :], self.movie_mat[:, movie_col])
 
-            return pred
+        # a movie added by partial_fit has no title, so it is shown by its id
+        movie_name = rf.get_movie_names([movie_id], self.movies)[0] or 'with id {}'.format(movie_id)
+        print("For user {} we predict a {} rating for the movie {}.".format(user_id, round(pred, 2), movie_name))
 
-        except:
-            print("I'm sorry, but a prediction cannot be made for this user-movie pair.  It looks like one of these items does not exist in our current database.")
+        return pred
 
+
+    def recommend_users(self, user_ids, rec_num=5, exclude_seen=True, chunk_size=1024):
+        '''
+        INPUT:
+        user_ids - a list or array of user ids from the reviews df
+        rec_num - number of recommendations to return for each user (int)
+        exclude_seen - (bool) leave out the movies the user already rated
+        chunk_size - (int) number of users scored in one matrix multiply, bounds memory to chunk_size x n_movies
+
+        OUTPUT:
+        recs - (dict) user_id -> numpy array of the recommended movie ids, best first.
+               Users not in the matrix factorization data are left out.
+        '''
+        user_ids = np.asarray(user_ids)
+        rows = rf.find_index(self.user_ids_series, self.user_sorter, user_ids)
+        user_ids, rows = user_ids[rows >= 0], rows[rows >= 0]
+
+        recs = {}
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+
+            # one matrix multiply scores every movie for the whole chunk of users
+            preds = np.dot(self.user_mat[chunk, :], self.movie_mat)
+
+            if exclude_seen:
+                starts, ends = self.seen_indptr[chunk], self.seen_indptr[chunk + 1]
+                counts = ends - starts
+                seen_rows = np.repeat(np.arange(len(chunk)), counts)
+                seen_pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+                preds[seen_rows, self.seen_cols[seen_pos]] = -np.inf
+
+            indices = rf.top_k(preds, rec_num)
+            for i, user_id in enumerate(user_ids[start:start + chunk_size]):
+                keep = indices[i][np.isfinite(preds[i, indices[i]])]
+                recs[user_id] = self.movie_ids_series[keep]
+
+        return recs
+
+
+    def similar_movies(self, movie_id, rec_num=5):
+        '''
+        INPUT:
+        movie_id - the movie_id from the reviews df
+        rec_num - number of similar movies to return (int)
+
+        OUTPUT:
+        rec_ids - (np array) the movie ids closest to movie_id in the FunkSVD latent space,
+                  best first, or None if the movie is not in the matrix factorization data
+        '''
+        movie_col = rf.find_index(self.movie_ids_series, self.movie_sorter, [movie_id])[0]
+        if movie_col < 0:
             return None
 
+        indices, _ = rf.query_lsh_index(self.lsh_index, self.movie_mat, movie_col, rec_num)
+
+        return self.movie_ids_series[indices]
+
 
     def make_recommendations(self, _id, _id_type='movie', rec_num=5):
         '''
         INPUT:
         _id - either a user or movie id (int)
-        _id_type - "movie" or "user" (str)
+        _id_type - "movie", "user" or "latent" (str) - "latent" finds movies like the
+                   given movie from the FunkSVD movie factors instead of the content
         rec_num - number of recommendations to return (int)
 
         OUTPUT:
@@ -150,27 +518,28 @@ class Recommender():
         # For use with user indexing
         rec_ids, rec_names = None, None
         if _id_type == 'user':
-            if _id in self.user_ids_series:
-                # Get the index of which row the user is in for use in U matrix
-                idx = np.where(self.user_ids_series == _id)[0][0]
-
-                # take the dot product of that row and the V matrix
-                preds = np.dot(self.user_mat[idx,:],self.movie_mat)
-
-                # pull the top movies according to the prediction
-                indices = preds.argsort()[-rec_num:][::-1] #indices
-                rec_ids = self.movie_ids_series[indices]
+            if rf.find_index(self.user_ids_series, self.user_sorter, [_id])[0] >= 0:
+                # pull the top unseen movies according to the prediction
+                rec_ids = self.recommend_users([_id], rec_num)[_id]
                 rec_names = rf.get_movie_names(rec_ids, self.movies)
 
             else:
                 # if we don't have this user, give just top ratings back
-                rec_names = rf.popular_recommendations(_id, rec_num, self.ranked_movies)
+                rec_names = rf.popular_recommendations(_id, rec_num, self.ranked_titles)
                 print("Because this user wasn't in our database, we are giving back the top movie recommendations for all users.")
 
+        # Find movies close to the given movie in the latent space
+        elif _id_type == 'latent':
+            rec_ids = self.similar_movies(_id, rec_num)
+            if rec_ids is not None:
+                rec_names = rf.get_movie_names(rec_ids, self.movies)
+            else:
+                print("That movie wasn't in our ratings data.  Sorry, we don't have any recommendations for you.")
+
         # Find similar movies if it is a movie that is passed
         else:
-            if _id in self.movie_ids_series:
-                rec_names = list(rf.find_similar_movies(_id, self.movies))[:rec_num]
+            if _id in self.movie_ids_series and self.movies['movie'][self.movies['movie_id'] == _id].notnull().any():
+                rec_names = list(rf.find_similar_movies(_id, self.movies, self.content_mat))[:rec_num]
             else:
                 print("That movie doesn't exist in our database.  Sorry, we don't have any recommendations for you.")
 
@@ -188,11 +557,16 @@ if __name__ == '__main__':
     # predict
     rec.predict_rating(user_id=8, movie_id=2844)
 
+    # save and reload the fitted model
+    rec.save('recommender_model')
+    rec = r.Recommender.load('recommender_model')
+
     # make recommendations
     print(rec.make_recommendations(8,'user')) # user in the dataset
     print(rec.make_recommendations(1,'user')) # user not in dataset
     print(rec.make_recommendations(1853728)) # movie in the dataset
     print(rec.make_recommendations(1)) # movie not in dataset
+    print(rec.make_recommendations(1853728, 'latent')) # movies like this one from the ratings
     print(rec.n_users)
     print(rec.n_movies)
     print(rec.num_ratings)
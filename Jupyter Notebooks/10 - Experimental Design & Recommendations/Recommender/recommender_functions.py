@@ -1,41 +1,129 @@
+import multiprocessing as mp
 import numpy as np
 import pandas as pd
 
+# columns read from the reviews csv, with narrow types to keep the rating triples small
+REVIEW_DTYPES = {'user_id': np.int32, 'movie_id': np.int32, 'rating': np.float32, 'date': str}
+
+# number of set bits in each possible byte, used to compare bit-packed content rows
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
 def get_movie_names(movie_ids, movies_df):
     '''
     INPUT
     movie_ids - a list of movie_ids
     movies_df - original movies dataframe
     OUTPUT
-    movies - a list of movie names associated with the movie_ids
+    movies - a list of movie names associated with the movie_ids, None for a movie without a name
 
     '''
-    # Read in the datasets
-    movie_lst = list(movies_df[movies_df['movie_id'].isin(movie_ids)]['movie'])
+    # Read in the datasets - keep the order of movie_ids, which is the ranking for recommendations
+    movie_names = movies_df.drop_duplicates('movie_id').set_index('movie_id')['movie']
+    movie_lst = [name if isinstance(name, str) else None for name in movie_names.reindex(movie_ids)]
 
     return movie_lst
 
 
-def create_ranked_df(movies, reviews):
+def create_movie_stats(reviews):
+    '''
+    INPUT
+    reviews - the reviews dataframe, or a chunk of it
+
+    OUTPUT
+    movie_stats - a dataframe indexed by movie_id with the sum of the ratings, the number of ratings
+                  and the date of the last rating of each movie, from a single groupby pass
+    '''
+    movie_stats = reviews.groupby('movie_id').agg({'rating': ['sum', 'count'], 'date': 'max'})
+    movie_stats.columns = ['sum_rating', 'num_ratings', 'last_rating']
+
+    return movie_stats
+
+
+def update_movie_stats(movie_stats, new_reviews, replaced=None):
+    '''
+    INPUT
+    movie_stats - a dataframe from create_movie_stats
+    new_reviews - a dataframe of reviews not yet counted in movie_stats
+    replaced - (np array) for each new review, the counted rating it replaces for the same user-movie pair,
+               NaN if the pair had no rating: a replacement moves the sum of the ratings, not their count
+
+    OUTPUT
+    movie_stats - the combined statistics, computed without going back over the old reviews
+    '''
+    stats = [movie_stats, create_movie_stats(new_reviews)]
+    if replaced is not None:
+        replaced = np.asarray(replaced, dtype=float)
+        was_rated = ~np.isnan(replaced)
+        stats.append(pd.DataFrame({'sum_rating': -replaced[was_rated], 'num_ratings': -1, 'last_rating': np.nan},
+                                  index=np.asarray(new_reviews['movie_id'])[was_rated]))
+    movie_stats = pd.concat(stats)
+    movie_stats = movie_stats.groupby(level=0).agg({'sum_rating': 'sum', 'num_ratings': 'sum', 'last_rating': 'max'})
+
+    return movie_stats.rename_axis('movie_id')
+
+
+def create_rating_triples(review_chunks):
+    '''
+    INPUT
+    review_chunks - an iterable of reviews dataframes with the 'user_id', 'movie_id', 'rating' and 'date'
+                    columns, e.g. from pd.read_csv(..., chunksize=...)
+
+    OUTPUT
+    user_ids - (np array) the sorted unique user ids, the user of row i is user_ids[i]
+    movie_ids - (np array) the sorted unique movie ids, the movie of column j is movie_ids[j]
+    rating_rows, rating_cols, rating_vals - (np array) the user row, movie column and rating of each
+                    user-movie pair, in user then movie order, keeping the highest rating of a pair
+    movie_stats - the rating statistics of each movie, see create_movie_stats
+    '''
+    users, movies, ratings = [], [], []
+    movie_stats = None
+
+    # only the narrow id and rating columns of each chunk are kept
+    for chunk in review_chunks:
+        chunk = chunk[chunk['rating'].notnull()]
+        users.append(np.asarray(chunk['user_id'], dtype=np.int32))
+        movies.append(np.asarray(chunk['movie_id'], dtype=np.int32))
+        ratings.append(np.asarray(chunk['rating'], dtype=np.float32))
+        if movie_stats is None:
+            movie_stats = create_movie_stats(chunk)
+        else:
+            movie_stats = update_movie_stats(movie_stats, chunk)
+
+    user_ids, rating_rows = np.unique(np.concatenate(users), return_inverse=True)
+    del users
+    movie_ids, rating_cols = np.unique(np.concatenate(movies), return_inverse=True)
+    del movies
+    rating_vals = np.concatenate(ratings)
+    del ratings
+
+    # sort by user-movie pair then rating, and keep the last (highest) rating of each pair
+    keys = rating_rows.astype(np.int64) * len(movie_ids) + rating_cols
+    order = np.lexsort((rating_vals, keys))
+    keys = keys[order]
+    last = np.append(keys[1:] != keys[:-1], True)
+    order = order[last]
+
+    return (user_ids, movie_ids, rating_rows[order].astype(np.int32), rating_cols[order].astype(np.int32),
+            rating_vals[order], movie_stats)
+
+
+def create_ranked_df(movies, reviews=None, movie_stats=None):
         '''
         INPUT
         movies - the movies dataframe
-        reviews - the reviews dataframe
+        reviews - the reviews dataframe, not needed if movie_stats is given
+        movie_stats - the movie rating statistics from create_movie_stats or update_movie_stats
 
         OUTPUT
         ranked_movies - a dataframe with movies that are sorted by highest avg rating, more reviews, then time, and must have more than 4 ratings
         '''
 
-        # Pull the average ratings and number of ratings for each movie
-        movie_ratings = reviews.groupby('movie_id')['rating']
-        avg_ratings = movie_ratings.mean()
-        num_ratings = movie_ratings.count()
-        last_rating = pd.DataFrame(reviews.groupby('movie_id').max()['date'])
-        last_rating.columns = ['last_rating']
-
-        # Add Dates
-        rating_count_df = pd.DataFrame({'avg_rating': avg_ratings, 'num_ratings': num_ratings})
-        rating_count_df = rating_count_df.join(last_rating)
+        # Pull the average ratings, number of ratings and last rating date for each movie
+        if movie_stats is None:
+            movie_stats = create_movie_stats(reviews)
+        rating_count_df = pd.DataFrame({'avg_rating': movie_stats['sum_rating'] / movie_stats['num_ratings'],
+                                        'num_ratings': movie_stats['num_ratings'],
+                                        'last_rating': movie_stats['last_rating']})
 
         # merge with the movies dataset
         movie_recs = movies.set_index('movie_id').join(rating_count_df)
@@ -49,23 +137,41 @@ def create_ranked_df(movies, reviews):
         return ranked_movies
 
 
-def find_similar_movies(movie_id, movies_df):
+def create_content_matrix(movies_df):
+    '''
+    INPUT
+    movies_df - original movies dataframe
+    OUTPUT
+    content_mat - (np array) the 0/1 content columns (century and genre dummies after 'date')
+                  bit-packed into uint8, one row per movie in movies_df order
+    '''
+    content_cols = movies_df.columns[movies_df.columns.get_loc('date') + 1:]
+    content_mat = np.packbits(np.array(movies_df[content_cols]) > 0, axis=1)
+
+    return content_mat
+
+
+def find_similar_movies(movie_id, movies_df, content_mat=None):
     '''
     INPUT
     movie_id - a movie_id
     movies_df - original movies dataframe
+    content_mat - (np array) the bit-packed content matrix from create_content_matrix,
+                  built from movies_df if not given
     OUTPUT
     similar_movies - an array of the most similar movies by title
     '''
-    # dot product to get similar movies
-    movie_content = np.array(movies_df.iloc[:,4:])
-    dot_prod_movies = movie_content.dot(np.transpose(movie_content))
+    if content_mat is None:
+        content_mat = create_content_matrix(movies_df)
 
     # find the row of each movie id
     movie_idx = np.where(movies_df['movie_id'] == movie_id)[0][0]
 
+    # dot product of this movie with every movie - for 0/1 content it is the count of shared bits
+    dot_prod_movie = POPCOUNT[content_mat & content_mat[movie_idx]].sum(axis=1)
+
     # find the most similar movie indices - to start I said they need to be the same for all content
-    similar_idxs = np.where(dot_prod_movies[movie_idx] == np.max(dot_prod_movies[movie_idx]))[0]
+    similar_idxs = np.where(dot_prod_movie == np.max(dot_prod_movie))[0]
 
     # pull the movie titles based on the indices
     similar_movies = np.array(movies_df.iloc[similar_idxs, ]['movie'])
@@ -78,12 +184,338 @@ def popular_recommendations(user_id, n_top, ranked_movies):
     INPUT:
     user_id - the user_id (str) of the individual you are making recommendations for
     n_top - an integer of the number recommendations you want back
-    ranked_movies - a pandas dataframe of the already ranked movies based on avg rating, count, and time
+    ranked_movies - a pandas dataframe of the already ranked movies based on avg rating, count, and time,
+                    or an array of their titles in that order
 
     OUTPUT:
     top_movies - a list of the n_top recommended movies by movie title in order best to worst
     '''
+    if isinstance(ranked_movies, pd.DataFrame):
+        ranked_movies = ranked_movies['movie']
 
-    top_movies = list(ranked_movies['movie'][:n_top])
+    top_movies = np.asarray(ranked_movies[:n_top]).tolist()    # python strings, not numpy scalars
 
     return top_movies
+
+
+def create_seen_index(rating_rows, rating_cols, n_users):
+    '''
+    INPUT
+    rating_rows - (np array) the user row index of each rating
+    rating_cols - (np array) the movie column index of each rating
+    n_users - (int) the number of users
+
+    OUTPUT
+    seen_indptr - (np array) n_users + 1 offsets into seen_cols
+    seen_cols - (np array) movie columns grouped by user, so the movies rated by
+                user row i are seen_cols[seen_indptr[i]:seen_indptr[i+1]]
+    '''
+    order = np.argsort(rating_rows, kind='mergesort')
+    seen_cols = rating_cols[order]
+
+    seen_indptr = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rating_rows, minlength=n_users), out=seen_indptr[1:])
+
+    return seen_indptr, seen_cols
+
+
+def find_index(ids_series, sorter, ids):
+    '''
+    INPUT
+    ids_series - (np array) the ids in matrix order
+    sorter - (np array) the indices that sort ids_series
+    ids - a list or array of ids to look up
+
+    OUTPUT
+    idx - (np array) the position of each id in ids_series, -1 if it does not exist
+    '''
+    ids = np.asarray(ids)
+    pos = np.searchsorted(ids_series, ids, sorter=sorter)
+    pos = np.minimum(pos, len(ids_series) - 1)
+    idx = sorter[pos]
+    idx[ids_series[idx] != ids] = -1
+
+    return idx
+
+
+def top_k(scores, k):
+    '''
+    INPUT
+    scores - (np array) a 2d array of scores with one row per user
+    k - (int) the number of top scores to keep in each row
+
+    OUTPUT
+    top_idx - (np array) the column indices of the k highest scores in each row, best first
+    '''
+    k = min(k, scores.shape[1])
+    rows = np.arange(scores.shape[0])[:, None]
+
+    # argpartition only puts the k best in front, then we just sort those k
+    if k < scores.shape[1]:
+        top_idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top_idx = np.tile(np.arange(k), (scores.shape[0], 1))
+    order = np.argsort(-scores[rows, top_idx], axis=1, kind='mergesort')
+
+    return top_idx[rows, order]
+
+
+def lsh_keys(planes, vectors):
+    '''
+    INPUT
+    planes - (np array) n_tables x n_bits x latent_features random hyperplanes
+    vectors - (np array) latent_features x n vectors to hash
+
+    OUTPUT
+    keys - (np array) n_tables x n bucket keys, one bit per hyperplane the vector lies above
+    '''
+    bits = np.einsum('tbk,kn->tbn', planes, vectors) > 0
+    powers = np.left_shift(1, np.arange(planes.shape[1], dtype=np.int64))
+
+    return np.einsum('tbn,b->tn', bits.astype(np.int64), powers)
+
+
+def create_lsh_index(item_factors, n_tables=8, n_bits=10, seed=42):
+    '''
+    INPUT
+    item_factors - (np array) latent_features x n_items matrix, e.g. the FunkSVD movie_mat
+    n_tables - (int) the number of hash tables, more tables find more true neighbours
+    n_bits - (int) the number of hyperplanes per table, more bits make smaller buckets
+    seed - (int) seed for the random hyperplanes
+
+    OUTPUT
+    lsh_index - (dict) random-projection LSH index for cosine similarity, all values np arrays:
+        planes - n_tables x n_bits x latent_features random hyperplanes
+        bucket_items - n_tables x n_items item columns sorted by bucket key in each table
+        bucket_keys - n_tables x n_items the sorted bucket keys matching bucket_items
+        norms - n_items norm of each item vector
+    '''
+    rng = np.random.RandomState(seed)
+    planes = rng.randn(n_tables, n_bits, item_factors.shape[0])
+
+    keys = lsh_keys(planes, item_factors)
+    bucket_items = np.argsort(keys, axis=1, kind='mergesort')
+    bucket_keys = np.take_along_axis(keys, bucket_items, axis=1)
+
+    lsh_index = {'planes': planes,
+                 'bucket_items': bucket_items,
+                 'bucket_keys': bucket_keys,
+                 'norms': np.linalg.norm(item_factors, axis=0)}
+
+    return lsh_index
+
+
+def query_lsh_index(lsh_index, item_factors, item_idx, k):
+    '''
+    INPUT
+    lsh_index - (dict) the index from create_lsh_index
+    item_factors - (np array) the latent_features x n_items matrix the index was built on
+    item_idx - (int) the column of the item to find neighbours for
+    k - (int) the number of neighbours to return
+
+    OUTPUT
+    neighbours - (np array) the columns of the k most similar items, best first
+    sims - (np array) the cosine similarity of each neighbour
+    '''
+    query = item_factors[:, item_idx]
+    keys = lsh_keys(lsh_index['planes'], query[:, None])[:, 0]
+
+    # candidates are the items sharing a bucket with the query in any table
+    candidates = []
+    for table, key in enumerate(keys):
+        lo = np.searchsorted(lsh_index['bucket_keys'][table], key, side='left')
+        hi = np.searchsorted(lsh_index['bucket_keys'][table], key, side='right')
+        candidates.append(lsh_index['bucket_items'][table, lo:hi])
+    candidates = np.unique(np.concatenate(candidates))
+    candidates = candidates[candidates != item_idx]
+
+    # for tiny buckets fall back to scoring every item
+    if len(candidates) < k:
+        candidates = np.arange(item_factors.shape[1])
+        candidates = candidates[candidates != item_idx]
+
+    # re-rank the candidates by their exact cosine similarity
+    norms = lsh_index['norms'][candidates] * lsh_index['norms'][item_idx]
+    sims = np.dot(query, item_factors[:, candidates]) / np.maximum(norms, 1e-12)
+    top = top_k(sims[None, :], k)[0]
+
+    return candidates[top], sims[top]
+
+
+def sgd_epoch(user_mat, movie_mat, rating_rows, rating_cols, rating_vals, learning_rate):
+    '''
+    INPUT
+    user_mat - (np array) n_users x latent_features user factors, updated in place
+    movie_mat - (np array) latent_features x n_movies movie factors, updated in place
+    rating_rows, rating_cols, rating_vals - (np array) the user row, movie column and value of each rating
+    learning_rate - (float) the learning rate
+
+    OUTPUT
+    sse_accum - the sum of squared errors over the ratings during this pass of FunkSVD gradient descent
+    '''
+    sse_accum = 0
+
+    for i, j, rating in zip(rating_rows, rating_cols, rating_vals):
+
+        # compute the error as the actual minus the dot product of the user and movie latent features
+        diff = rating - np.dot(user_mat[i, :], movie_mat[:, j])
+
+        # Keep track of the sum of squared errors for the matrix
+        sse_accum += diff**2
+
+        # update the values in each matrix in the direction of the gradient
+        user_mat[i, :] += learning_rate * (2*diff*movie_mat[:, j])
+        movie_mat[:, j] += learning_rate * (2*diff*user_mat[i, :])
+
+    return sse_accum
+
+
+def rating_errors(user_mat, movie_mat, rating_rows, rating_cols, rating_vals):
+    '''
+    INPUT
+    user_mat - (np array) n_users x latent_features user factors
+    movie_mat - (np array) latent_features x n_movies movie factors
+    rating_rows, rating_cols, rating_vals - (np array) the user row, movie column and value of each rating
+
+    OUTPUT
+    errors - (np array) the actual minus the predicted rating for every rating, without a Python loop
+    '''
+    preds = np.einsum('ij,ji->i', user_mat[rating_rows, :], movie_mat[:, rating_cols])
+
+    return rating_vals - preds
+
+
+# factor matrices and rating blocks shared with the parallel gradient descent workers
+_sgd_shared = {}
+
+
+def _init_sgd_worker(user_buf, movie_buf, user_shape, movie_shape, rating_rows, rating_cols, rating_vals, blocks):
+    '''
+    Runs once in each worker process - wraps the shared buffers as numpy arrays without copying them
+    '''
+    _sgd_shared['user_mat'] = np.frombuffer(user_buf).reshape(user_shape)
+    _sgd_shared['movie_mat'] = np.frombuffer(movie_buf).reshape(movie_shape)
+    _sgd_shared['ratings'] = (rating_rows, rating_cols, rating_vals)
+    _sgd_shared['blocks'] = blocks
+
+
+def _sgd_block(task):
+    '''
+    Runs one gradient descent pass over the ratings of one (user block, movie block) in a worker process
+    '''
+    block, learning_rate = task
+    idx = _sgd_shared['blocks'][block]
+    rating_rows, rating_cols, rating_vals = _sgd_shared['ratings']
+
+    return sgd_epoch(_sgd_shared['user_mat'], _sgd_shared['movie_mat'],
+                     rating_rows[idx], rating_cols[idx], rating_vals[idx], learning_rate)
+
+
+class ParallelSGD():
+    '''
+    Multi-core FunkSVD gradient descent. The ratings are split into n_jobs x n_jobs blocks by user and
+    movie, and each pass runs n_jobs rounds; in round s worker p takes block (p, (p + s) % n_jobs), so
+    the workers of a round never touch the same user row or movie column and can update the shared
+    user_mat and movie_mat without locks.
+    '''
+    def __init__(self, user_mat, movie_mat, rating_rows, rating_cols, rating_vals, n_jobs):
+        '''
+        INPUT
+        user_mat - (np array) n_users x latent_features initial user factors
+        movie_mat - (np array) latent_features x n_movies initial movie factors
+        rating_rows, rating_cols, rating_vals - (np array) the user row, movie column and value of each rating
+        n_jobs - (int) the number of worker processes
+
+        The factors are copied into shared memory, read them back from self.user_mat and self.movie_mat
+        '''
+        self.n_jobs = n_jobs
+
+        user_buf = mp.RawArray('d', user_mat.size)
+        movie_buf = mp.RawArray('d', movie_mat.size)
+        self.user_mat = np.frombuffer(user_buf).reshape(user_mat.shape)
+        self.movie_mat = np.frombuffer(movie_buf).reshape(movie_mat.shape)
+        self.user_mat[:] = user_mat
+        self.movie_mat[:] = movie_mat
+
+        # spread users and movies over the blocks at random so the blocks are about the same size
+        rng = np.random.RandomState(0)
+        user_block = rng.randint(n_jobs, size=user_mat.shape[0])[rating_rows]
+        movie_block = rng.randint(n_jobs, size=movie_mat.shape[1])[rating_cols]
+        blocks = {(a, b): np.nonzero((user_block == a) & (movie_block == b))[0]
+                  for a in range(n_jobs) for b in range(n_jobs)}
+
+        self.pool = mp.Pool(n_jobs, initializer=_init_sgd_worker,
+                            initargs=(user_buf, movie_buf, user_mat.shape, movie_mat.shape,
+                                      rating_rows, rating_cols, rating_vals, blocks))
+
+    def epoch(self, learning_rate):
+        '''
+        INPUT
+        learning_rate - (float) the learning rate
+
+        OUTPUT
+        sse_accum - the sum of squared errors over all the ratings during this pass
+        '''
+        sse_accum = 0
+        for shift in range(self.n_jobs):
+            tasks = [((p, (p + shift) % self.n_jobs), learning_rate) for p in range(self.n_jobs)]
+            sse_accum += sum(self.pool.map(_sgd_block, tasks))
+
+        return sse_accum
+
+    def close(self):
+        '''
+        Stops the worker processes
+        '''
+        self.pool.close()
+        self.pool.join()
+
+
+def solve_factors(fixed_factors, ratings, reg=0.1):
+    '''
+    INPUT
+    fixed_factors - (np array) latent_features x n factors of the movies (or users) that were rated
+    ratings - (np array) the n ratings
+    reg - (float) ridge penalty keeping the solution small when there are few ratings
+
+    OUTPUT
+    factors - (np array) the latent_features vector that best reproduces the ratings from the fixed factors
+    '''
+    gram = np.dot(fixed_factors, fixed_factors.T) + reg * np.eye(fixed_factors.shape[0])
+
+    return np.linalg.solve(gram, np.dot(fixed_factors, ratings))
+
+
+def encode_strings(values):
+    '''
+    INPUT
+    values - a list, array or series of strings, where None or NaN are missing values
+
+    OUTPUT
+    blob - (np array) the uint8 UTF-8 bytes of all the strings, one after the other
+    offsets - (np array) len(values) + 1 int64 offsets into blob, string i is blob[offsets[i]:offsets[i+1]]
+    nulls - (np array) True for each missing value, stored as an empty string in blob
+    '''
+    nulls = np.array(pd.isnull(np.asarray(values, dtype=object)), dtype=bool)
+    encoded = [b'' if null else value.encode('utf-8') for value, null in zip(values, nulls)]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, nulls
+
+
+def decode_strings(blob, offsets, nulls=None):
+    '''
+    INPUT
+    blob, offsets, nulls - (np array) the output of encode_strings
+
+    OUTPUT
+    values - (np array) an object array of the decoded strings, NaN for the missing values
+    '''
+    data = np.asarray(blob).tobytes()
+    values = np.empty(len(offsets) - 1, dtype=object)
+    values[:] = [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+    if nulls is not None:
+        values[np.asarray(nulls)] = np.nan
+
+    return values
@@ -0,0 +1,112 @@
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from train import load_model, cpu_optimize, to_device, bf16_supported, autocast, quantize_classifier
+
+import argparse
+import copy
+import time
+
+# -----------------------------
+# Define command line Arguments
+# -----------------------------
+parser = argparse.ArgumentParser()
+parser.add_argument('--arch', type=str, default='alexnet', help='Model architecture')
+parser.add_argument('--batch_size', type=int, default=32, help='Number of images per batch')
+parser.add_argument('--batches', type=int, default=10, help='Number of timed batches per setting')
+parser.add_argument('--warmup', type=int, default=2, help='Number of untimed batches before timing each setting')
+parser.add_argument('--threads', type=int, help='Number of intra-op threads for the optimized settings (default is all cores)')
+parser.add_argument('--interop_threads', type=int, help='Number of inter-op threads for the optimized settings')
+
+args, _ = parser.parse_known_args()
+
+# -------------------------------------------------------------
+# Settings: name, channels_last, bf16, int8 classifier
+# -------------------------------------------------------------
+SETTINGS = [
+    ('default', False, False, False),
+    ('cpu_optimize', True, False, False),
+    ('cpu_optimize + bf16', True, True, False),
+    ('cpu_optimize + int8', True, False, True),
+]
+
+# -----------------------------------------------------
+# Time a number of batches, after some untimed warm-up
+# -----------------------------------------------------
+def images_per_second(step, images, batches, warmup):
+    for _ in range(warmup):
+        step(images)
+    start = time.time()
+    for _ in range(batches):
+        step(images)
+
+    return batches * len(images) / (time.time() - start)
+
+# --------------------------------------------------------
+# Measure training and inference images/s for each setting
+# --------------------------------------------------------
+def benchmark(arch='alexnet', batch_size=32, batches=10, warmup=2, threads=0, interop_threads=0):
+    device = torch.device('cpu')
+    base_model = load_model(arch=arch, pretrained=False)    # the weights don't change the timings
+    images = torch.randn(batch_size, 3, 224, 224)    # random images: only the arithmetic is timed, not the decoding
+    labels = torch.randint(0, base_model.classifier.hidden2.out_features, (batch_size,))
+    criterion = nn.NLLLoss()
+    default_threads = torch.get_num_threads()
+    results = []
+
+    for name, channels_last, bf16, int8 in SETTINGS:
+        if bf16 and not bf16_supported():
+            print('{}: bfloat16 is not supported by this CPU, skipped'.format(name))
+            continue
+        buNN = copy.deepcopy(base_model)
+        torch.set_num_threads(default_threads)
+        if channels_last:
+            buNN = cpu_optimize(buNN, threads=threads, interop_threads=interop_threads)
+        batch = to_device(images, device, channels_last)
+
+        # Training: forward through the frozen trunk, backward and step through the classifier only.
+        # Quantized layers can't be trained, so the int8 setting is inference only
+        train_ips = None
+        if not int8:
+            optimizer = optim.Adam(buNN.classifier.parameters(), lr=0.001)
+            buNN.train()
+
+            def train_step(batch):
+                optimizer.zero_grad()
+                with autocast(device, bf16):
+                    logps = buNN(batch)
+                loss = criterion(logps.float(), labels)
+                loss.backward()
+                optimizer.step()
+
+            train_ips = images_per_second(train_step, batch, batches, warmup)
+
+        # Inference
+        if int8:
+            buNN = quantize_classifier(buNN)
+        buNN.eval()
+
+        def inference_step(batch):
+            with torch.inference_mode(), autocast(device, bf16):
+                buNN(batch)
+
+        inference_ips = images_per_second(inference_step, batch, batches, warmup)
+
+        results.append((name, train_ips, inference_ips))
+        print('{}: {} threads\tTrain = {}\tInference = {:.1f} images/second'.format(
+            name, torch.get_num_threads(), '{:.1f} images/second'.format(train_ips) if train_ips else 'n/a', inference_ips))
+
+    # Summary table
+    print('\n{:<22}{:>14}{:>14}'.format('Setting', 'Train img/s', 'Infer img/s'))
+    for name, train_ips, inference_ips in results:
+        print('{:<22}{:>14}{:>14.1f}'.format(name, '{:.1f}'.format(train_ips) if train_ips else 'n/a', inference_ips))
+
+    return results
+
+# -------------------------------------
+# Execute benchmark() from command line
+# -------------------------------------
+if __name__ == '__main__':
+    benchmark(arch=args.arch, batch_size=args.batch_size, batches=args.batches, warmup=args.warmup,
+              threads=args.threads or 0, interop_threads=args.interop_threads or 0)
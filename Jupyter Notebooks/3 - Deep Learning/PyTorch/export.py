@@ -0,0 +1,109 @@
+import torch
+import torch.utils.data as data
+
+from predict import checkpoint_to_model, load_exported, list_images, ImageFiles, ImageProcessor
+
+import argparse
+import json
+import os
+import time
+
+# -----------------------------
+# Define command line Arguments
+# -----------------------------
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint', type=str, help='Model checkpoint to export')
+parser.add_argument('--output', type=str, help='Output file name without extension (default is the checkpoint name)')
+parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx', 'both'], help='Export format')
+parser.add_argument('--test_dir', type=str, help='Directory of test images on which eager and exported models are benchmarked')
+parser.add_argument('--batch_size', type=int, default=32, help='Number of images per batch when benchmarking')
+parser.add_argument('--draft', action='store_true', help='Decode the benchmark JPEGs downscaled, as predict.py --draft does')
+
+args, _ = parser.parse_known_args()
+
+# -------------------------------------------------------------------------
+# Export the model, classifier included, as TorchScript and/or ONNX graphs
+# -------------------------------------------------------------------------
+def export_model(checkpoint, output='', export_format='torchscript'):
+    if not checkpoint:
+        raise ValueError('Please pass Model Checkpoint using --checkpoint')
+    if not output:
+        output = os.path.splitext(checkpoint)[0]
+
+    buNN = checkpoint_to_model(checkpoint, False)
+    buNN.eval()
+    example = torch.randn(1, 3, 224, 224)
+    exported = []
+
+    # The graphs only hold tensors: the class mapping goes in a JSON file next to them
+    with open(output + '.json', 'w') as f:
+        json.dump({'arch': buNN.arch, 'class_to_idx': buNN.class_to_idx}, f)
+
+    if export_format in ('torchscript', 'both'):
+        # Trace, then freeze: the weights become constants the graph optimizations can fold.
+        # The CPU-specific fusions of optimize_for_inference can't be saved, so predict.py applies them at load time
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(buNN, example))
+        traced.save(output + '.pt')
+        exported.append(output + '.pt')
+
+    if export_format in ('onnx', 'both'):
+        torch.onnx.export(buNN, example, output + '.onnx', input_names=['images'], output_names=['logps'],
+                          dynamic_axes={'images': {0: 'batch'}, 'logps': {0: 'batch'}}, dynamo=False)
+        exported.append(output + '.onnx')
+
+    for path in exported:
+        print('Exported {} to {}'.format(checkpoint, path))
+
+    return exported
+
+# ---------------------------------------------------------
+# Compare eager and exported latency on the test data set
+# ---------------------------------------------------------
+def time_model(model, batches, single_images):
+    with torch.inference_mode():
+        model(single_images[0])    # warm-up: the first calls of an exported graph compile and optimize it
+        model(single_images[0])
+
+        start = time.time()
+        for image in single_images:
+            model(image)
+        latency = (time.time() - start) / len(single_images)
+
+        num_images = 0
+        start = time.time()
+        for images in batches:
+            model(images)
+            num_images += len(images)
+        throughput = num_images / (time.time() - start)
+
+    return latency, throughput
+
+def benchmark_exported(checkpoint, exported, test_dir, batch_size=32, draft=False):
+    files = list_images(test_dir)
+    # Preprocess up front, so that only the models are timed
+    image_processor = ImageProcessor(draft=draft)
+    batches = [image_processor.normalize(images) for images, _ in
+               data.DataLoader(ImageFiles(files, image_processor), batch_size=batch_size, shuffle=False)]
+    single_images = [image_processor(path).unsqueeze(0) for path in files[:min(len(files), 20)]]
+
+    eager = checkpoint_to_model(checkpoint, False)
+    eager.eval()
+    models = [('eager', eager)] + [('onnx' if path.endswith('.onnx') else 'torchscript', load_exported(path)) for path in exported]
+
+    with torch.inference_mode():
+        reference = eager(single_images[0])
+    print('\n{:<14}{:>18}{:>18}{:>14}'.format('Runtime', 'Latency (ms/img)', 'Batch img/s', 'Max |diff|'))
+    for name, model in models:
+        with torch.inference_mode():
+            difference = (model(single_images[0]) - reference).abs().max().item()
+        latency, throughput = time_model(model, batches, single_images)
+        print('{:<14}{:>18.2f}{:>18.1f}{:>14.2e}'.format(name, 1000 * latency, throughput, difference))
+
+# ----------------------------------------
+# Execute export_model() from command line
+# ----------------------------------------
+if __name__ == '__main__':
+    exported = export_model(args.checkpoint, output=args.output, export_format=args.format)
+    if args.test_dir:
+        benchmark_exported(args.checkpoint, exported, args.test_dir, batch_size=args.batch_size, draft=args.draft)
@@ -1,65 +1,195 @@
 import torch
+import torch.utils.data as data
 import torchvision.transforms as transforms
-from torchvision import datasets, transforms, models
+from torchvision import datasets, transforms
 import numpy as np
 
 from PIL import Image
-from train import load_model
+from train import load_model, cpu_optimize, to_device, bf16_supported, autocast, quantize_classifier
 
 import json
 import argparse
+import pickle
+import csv
+import glob
+import os
+import time
 
 # Define command line arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('--image', type=str, help='Image to predict')
+parser.add_argument('--images', type=str, help='Directory or glob pattern of images to predict in batches')
+parser.add_argument('--output', type=str, help='CSV or JSONL (.jsonl) file receiving the top K predictions of --images')
+parser.add_argument('--batch_size', type=int, help='Number of images per forward pass with --images')
+parser.add_argument('--workers', type=int, help='Number of worker processes decoding the --images')
 parser.add_argument('--checkpoint', type=str, help='Model checkpoint to use when predicting')
 parser.add_argument('--k', type=int, help='Return top K predictions')
 parser.add_argument('--labels', type=str, help='JSON file containing label names')
-parser.add_argument('--gpu', action='store_true', help='Use GPU if available')
+parser.add_argument('--gpu', action='store_true', help='Use GPU if available (eager runtime only)')
+parser.add_argument('--runtime', type=str, choices=['eager', 'torchscript', 'onnx'],
+                    help='Run the checkpoint in eager mode (default), or a --checkpoint exported by export.py as TorchScript (.pt) or ONNX (.onnx), always on the CPU')
+parser.add_argument('--mmap', action='store_true', help='Memory-map the checkpoint weights instead of reading them into memory')
+parser.add_argument('--cpu_optimize', action='store_true', help='Tune for CPU: thread pools and channels_last memory format')
+parser.add_argument('--threads', type=int, help='Number of intra-op threads (with --cpu_optimize; default is all cores)')
+parser.add_argument('--interop_threads', type=int, help='Number of inter-op threads (with --cpu_optimize)')
+parser.add_argument('--quantize', action='store_true', help='Quantize the classifier Linear layers to int8 (CPU only)')
+parser.add_argument('--bf16', action='store_true', help='Run the forward pass under bfloat16 autocast, where the CPU supports it')
+parser.add_argument('--draft', action='store_true', help='Decode JPEGs downscaled: faster on large images, but not the full decode the model was trained on')
 
 args, _ = parser.parse_known_args()
 
 # -------------------------------------
 # Rebuild the Model from the Checkpoint
 # -------------------------------------
-def checkpoint_to_model(checkpoint_file, gpu):
+def checkpoint_to_model(checkpoint_file, gpu, mmap=False):
     # Below 'cuda:0' is hardcoded because I couldn't find a way to extract it from the torch.device object!...
-    checkpoint = torch.load(checkpoint_file, map_location=('cuda:0' if torch.cuda.is_available() else 'cpu'))
+    map_location = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    try:
+        checkpoint = torch.load(checkpoint_file, map_location=map_location, mmap=mmap, weights_only=True)
+    except pickle.UnpicklingError:
+        # Checkpoints from before the hyper-parameters were saved pickle the whole classifier module
+        print('Old checkpoint format, unpickling its classifier: only load checkpoints you trust')
+        checkpoint = torch.load(checkpoint_file, map_location=map_location, mmap=mmap, weights_only=False)
     arch = checkpoint['arch']
     
-    if arch=='vgg16_bn':
-        model = models.vgg16_bn(pretrained=True)
-    elif arch=='alexnet':
-        model = models.alexnet(pretrained=True)
-    else:
-        raise ValueError('NN architecture only accepts vgg16_bn and alexnet, not ', arch)
-        
-    model.classifier = checkpoint['classifier']
+    # Build the architecture without any weights, on the meta device: the checkpoint holds all of them,
+    # so loading needs no download and no random initialization that would be overwritten anyway
+    with torch.device('meta'):
+        if 'classifier' in checkpoint:
+            model = load_model(arch=arch, pretrained=False)
+        else:
+            model = load_model(arch=arch, num_outputs=checkpoint['num_outputs'], num_h1=checkpoint['h1_units'],
+                               num_h2=checkpoint['h2_units'], dropout=checkpoint['dropout'], pretrained=False)
+    if 'classifier' in checkpoint:
+        model.classifier = checkpoint['classifier']
     model.class_to_idx = checkpoint['class_to_idx']
-    model.load_state_dict(checkpoint['state'])
+    model.arch = arch
+    model.load_state_dict(checkpoint['state'], assign=True)    # take the loaded (or memory-mapped) tensors as they are
     
     return model
 
+# ----------------------------------------------------------
+# Load a Model exported by export.py as TorchScript or ONNX
+# ----------------------------------------------------------
+class ExportedModel:
+    # Called like the eager model: a batch of image tensors in, log probabilities out
+    def __init__(self, path):
+        with open(os.path.splitext(path)[0] + '.json', 'r') as f:
+            sidecar = json.load(f)
+        self.arch = sidecar['arch']
+        self.class_to_idx = sidecar['class_to_idx']
+
+        if path.endswith('.onnx'):
+            import onnxruntime    # only needed for this runtime
+            self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            self.graph = None
+        else:
+            self.session = None
+            self.graph = torch.jit.optimize_for_inference(torch.jit.load(path, map_location='cpu'))    # fuse for the CPU
+
+    def __call__(self, images):
+        if self.session is not None:
+            return torch.from_numpy(self.session.run(None, {'images': images.contiguous().numpy()})[0])
+        return self.graph(images.contiguous())
+
+    forward = __call__
+
+def load_exported(path):
+    return ExportedModel(path)
+
+# ------------------------------------------------------------
+# Load the Model once, ready for inference on the chosen device
+# ------------------------------------------------------------
+def inference_device(gpu, runtime='eager'):
+    # The exported graphs are loaded, fused and run for the CPU, so --gpu only applies to the eager model
+    if runtime and runtime != 'eager':
+        if gpu:
+            print('The {} runtime runs on the CPU, ignoring --gpu'.format(runtime))
+        return torch.device('cpu')
+
+    return torch.device('cuda' if (gpu and torch.cuda.is_available()) else 'cpu')
+
+def prepare_model(checkpoint, device, cpu_optimized=False, threads=0, interop_threads=0, quantize=False, bf16=False, mmap=False,
+                  runtime='eager'):
+    load_start = time.time()
+    if runtime and runtime != 'eager':
+        # The exported graphs are already frozen and fused for the CPU, in float32
+        if threads:
+            torch.set_num_threads(threads)
+        buNN = load_exported(checkpoint)
+        print('{} model loaded in {:.3f}s'.format(runtime, time.time() - load_start))
+        return buNN, False, False
+
+    buNN = checkpoint_to_model(checkpoint, device.type == 'cuda', mmap=mmap)
+    print('Model loaded in {:.3f}s'.format(time.time() - load_start))
+    buNN.to(device)
+    buNN.eval()
+    channels_last = cpu_optimized and device.type == 'cpu'
+    if channels_last:
+        buNN = cpu_optimize(buNN, threads=threads, interop_threads=interop_threads)
+    if quantize and device.type == 'cpu':
+        buNN = quantize_classifier(buNN)
+    if bf16 and device.type == 'cpu' and (quantize or not bf16_supported()):
+        print('bfloat16 needs CPU support and no int8 classifier, running in float32')
+        bf16 = False
+
+    return buNN, channels_last, bf16
+
+def class_names(class_to_idx, labels=''):
+    # Name of each model output, from the label JSON if given, otherwise the class folder name
+    idx_to_class = {v : k for k,v in class_to_idx.items()}
+    classes = [idx_to_class[i] for i in range(len(idx_to_class))]
+    if labels:
+        with open(labels, 'r') as f:
+            class_to_name = json.load(f)
+        classes = [class_to_name[x] for x in classes]
+
+    return classes
+
 # -------------------------------------------------
 # Process an Image to match those used for training
 # -------------------------------------------------
+class ImageProcessor:
+    # Builds the transforms once, and splits the work in two: load() decodes, scales and crops one image
+    # to uint8, normalize() converts and normalizes a whole batch in one tensor operation
+    def __init__(self, resize=256, crop=224, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], draft=False):
+        self.resize = resize
+        self.draft = draft
+        self.transforms = transforms.Compose([transforms.Resize(resize),
+                                              transforms.CenterCrop(crop),
+                                              transforms.PILToTensor()])
+        # ToTensor's division by 255 is folded into the mean and standard deviation
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor(std).view(1, 3, 1, 1) * 255
+
+    def load(self, image_file):
+        pil_image = Image.open(image_file)    # load the PIL image from the file
+        if self.draft:
+            # Let the JPEG decoder scale down while decoding, keeping at least `resize` pixels on each side.
+            # Faster, but its pixels differ a little from those of the full decode used in training
+            pil_image.draft('RGB', (self.resize, self.resize))
+        
+        return self.transforms(pil_image.convert('RGB'))
+
+    def normalize(self, images):
+        # uint8 batch (N, 3, H, W) to normalized floats, on whichever device the batch is
+        images = images.float()
+        return images.sub_(self.mean.to(images.device)).div_(self.std.to(images.device))
+
+    def __call__(self, image_file):
+        return self.normalize(self.load(image_file).unsqueeze(0))[0]
+
+image_processor = ImageProcessor()
+
 def process_image(image_file):
-    pil_image = Image.open(image_file)    # load the PIL image from the file
-    
     # Scale, crop, and normalize
-    image_transforms = transforms.Compose([transforms.Resize(256),
-                                           transforms.CenterCrop(224),
-                                           transforms.ToTensor(),
-                                           transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-    
-    image_tensor = image_transforms(pil_image)
-    
-    return image_tensor
+    return image_processor(image_file)
 
 # ------------------------------------------------
 # Predict the Image's Class using a pre-trained NN
 # ------------------------------------------------
-def predict(image, checkpoint, k=5, labels='', gpu=False):
+def predict(image, checkpoint, k=5, labels='', gpu=False, cpu_optimized=False, threads=0, interop_threads=0, quantize=False, bf16=False,
+            mmap=False, runtime='eager', draft=False):
     
     # Read command line arguments
     if args.image:
@@ -76,28 +206,42 @@ def predict(image, checkpoint, k=5, labels='', gpu=False):
         labels = args.labels
     if args.gpu:
         gpu = args.gpu
+    if args.cpu_optimize:
+        cpu_optimized = True
+    if args.threads:
+        threads = args.threads
+    if args.interop_threads:
+        interop_threads = args.interop_threads
+    if args.quantize:
+        quantize = True
+    if args.bf16:
+        bf16 = True
+    if args.mmap:
+        mmap = True
+    if args.runtime:
+        runtime = args.runtime
+    if args.draft:
+        draft = True
         
     print('Image: {}\tCheckpoint: {}\tK: {}\tLabels: {}\tGPU: {}'.format(image, checkpoint, k, labels, gpu))
     
     # Load the model from the checkpoint; use GPU if selected and available
-    device = torch.device('cuda' if (gpu and torch.cuda.is_available()) else 'cpu')
-    buNN = checkpoint_to_model(checkpoint, gpu)
-    buNN.to(device)
-    buNN.eval()
+    device = inference_device(gpu, runtime)
+    buNN, channels_last, bf16 = prepare_model(checkpoint, device, cpu_optimized=cpu_optimized, threads=threads,
+                                              interop_threads=interop_threads, quantize=quantize, bf16=bf16, mmap=mmap,
+                                              runtime=runtime)
     
     # Process the Image before estimating its Class
-    image_torch = process_image(image)
-    image_torch = image_torch.to(device)
-    image_torch = image_torch.unsqueeze_(0)
-    image_torch = image_torch.float()
-    image_torch.to(device)
+    processor = ImageProcessor(draft=draft)
+    image_torch = processor.load(image).unsqueeze(0)
+    image_torch = to_device(processor.normalize(image_torch.to(device)), device, channels_last)
     
     # Run the Model in inference/estimation mode
-    with torch.no_grad():
+    with torch.inference_mode(), autocast(device, bf16):
         logps = buNN.forward(image_torch)
         
     # Calculate the top Probabilities and Classes
-    ps = torch.exp(logps)
+    ps = torch.exp(logps.float())
     probabilities, indices = ps.topk(k)
     probabilities = probabilities.tolist()[0]
     indices = indices.tolist()[0]
@@ -120,8 +264,132 @@ def predict(image, checkpoint, k=5, labels='', gpu=False):
     
     return probabilities, classes
 
+# ----------------------------------------------
+# Predict the Classes of many Images in batches
+# ----------------------------------------------
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+def list_images(images):
+    # A directory is searched recursively for image files; anything else is a glob pattern
+    if os.path.isdir(images):
+        files = [os.path.join(root, name) for root, _, names in os.walk(images) for name in names
+                 if name.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        files = glob.glob(images, recursive=True)
+
+    return sorted(files)
+
+class ImageFiles(data.Dataset):
+    # Decodes, scales and crops the images in the DataLoader workers, in parallel with the forward passes.
+    # They come back as uint8, a quarter of the float size, and are normalized by batch
+    def __init__(self, files, processor=image_processor):
+        self.files = files
+        self.processor = processor
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        return self.processor.load(self.files[index]), index
+
+def write_predictions(output, files, probabilities, classes):
+    if output.endswith('.jsonl'):
+        with open(output, 'w') as f:
+            for image, image_probabilities, image_classes in zip(files, probabilities, classes):
+                f.write(json.dumps({'image': image, 'classes': image_classes, 'probabilities': image_probabilities}) + '\n')
+    else:
+        with open(output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['image', 'rank', 'class', 'probability'])
+            for image, image_probabilities, image_classes in zip(files, probabilities, classes):
+                for rank, (c, p) in enumerate(zip(image_classes, image_probabilities), 1):
+                    writer.writerow([image, rank, c, p])
+
+def predict_images(images, checkpoint, k=5, labels='', gpu=False, output='', batch_size=32, workers=0,
+                   cpu_optimized=False, threads=0, interop_threads=0, quantize=False, bf16=False, mmap=False, runtime='eager',
+                   draft=False):
+
+    # Read command line arguments
+    if args.images:
+        images = args.images
+    if args.checkpoint:
+        checkpoint = args.checkpoint
+    if args.k:
+        k = args.k
+    if args.labels:
+        labels = args.labels
+    if args.gpu:
+        gpu = args.gpu
+    if args.output:
+        output = args.output
+    if args.batch_size:
+        batch_size = args.batch_size
+    if args.workers:
+        workers = args.workers
+    if args.cpu_optimize:
+        cpu_optimized = True
+    if args.threads:
+        threads = args.threads
+    if args.interop_threads:
+        interop_threads = args.interop_threads
+    if args.quantize:
+        quantize = True
+    if args.bf16:
+        bf16 = True
+    if args.mmap:
+        mmap = True
+    if args.runtime:
+        runtime = args.runtime
+    if args.draft:
+        draft = True
+
+    files = list_images(images)
+    if not files:
+        raise ValueError('No images found in ', images)
+    print('Images: {} ({} files)\tCheckpoint: {}\tK: {}\tLabels: {}\tGPU: {}\tOutput: {}'.format(
+        images, len(files), checkpoint, k, labels, gpu, output))
+
+    # Load the model and the label names only once for all the images
+    device = inference_device(gpu, runtime)
+    buNN, channels_last, bf16 = prepare_model(checkpoint, device, cpu_optimized=cpu_optimized, threads=threads,
+                                              interop_threads=interop_threads, quantize=quantize, bf16=bf16, mmap=mmap,
+                                              runtime=runtime)
+    names = class_names(buNN.class_to_idx, labels)
+
+    processor = ImageProcessor(draft=draft)
+    dataloader = data.DataLoader(ImageFiles(files, processor), batch_size=batch_size, shuffle=False, num_workers=workers,
+                                 pin_memory=(device.type == 'cuda'))
+    probabilities = [None] * len(files)
+    classes = [None] * len(files)
+
+    start = time.time()
+    done = 0
+    for batch, (images_torch, indices) in enumerate(dataloader):
+        images_torch = to_device(processor.normalize(images_torch.to(device, non_blocking=True)), device, channels_last)
+        with torch.inference_mode(), autocast(device, bf16):
+            logps = buNN(images_torch)
+        top_ps, top_classes = torch.exp(logps.float()).topk(k, dim=1)
+
+        for i, image_ps, image_classes in zip(indices.tolist(), top_ps.tolist(), top_classes.tolist()):
+            probabilities[i] = image_ps
+            classes[i] = [names[c] for c in image_classes]
+
+        done += len(indices)
+        if (batch + 1) % 10 == 0 or done == len(files):
+            print('{}/{} images\t{:.1f} images/second'.format(done, len(files), done / (time.time() - start)))
+
+    if output:
+        write_predictions(output, files, probabilities, classes)
+        print('Top {} predictions written to {}'.format(k, output))
+
+    return files, probabilities, classes
+
 # -----------------------------------
 # Execute predict() from command line
 # -----------------------------------
-if args.image and args.checkpoint:
-    predict(args.image, args.checkpoint)
\ No newline at end of file
+# The __main__ guard keeps DataLoader workers, which may re-import this file, from predicting again
+if __name__ == '__main__' and args.checkpoint:
+    if args.images:
+        predict_images(args.images, args.checkpoint)
+    elif args.image:
+        predict(args.image, args.checkpoint)
\ No newline at end of file
@@ -0,0 +1,215 @@
+import torch
+
+from predict import inference_device, prepare_model, class_names, image_processor, ImageProcessor
+from train import to_device, autocast
+
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+
+# -----------------------------
+# Define command line Arguments
+# -----------------------------
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint', type=str, help='Model checkpoint to serve')
+parser.add_argument('--labels', type=str, default='', help='JSON file containing label names')
+parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+parser.add_argument('--k', type=int, default=5, help='Default number of top predictions returned')
+parser.add_argument('--max_batch', type=int, default=16, help='Maximum number of requests run in one forward pass')
+parser.add_argument('--max_wait_ms', type=float, default=5, help='How long the first request of a batch waits for others')
+parser.add_argument('--stats_window', type=int, default=10000, help='Number of latest requests and batches /stats is computed from')
+parser.add_argument('--gpu', action='store_true', help='Use GPU if available (eager runtime only)')
+parser.add_argument('--runtime', type=str, default='eager', choices=['eager', 'torchscript', 'onnx'],
+                    help='Serve the checkpoint in eager mode, or a --checkpoint exported by export.py, always on the CPU')
+parser.add_argument('--mmap', action='store_true', help='Memory-map the checkpoint weights')
+parser.add_argument('--cpu_optimize', action='store_true', help='Tune for CPU: thread pools and channels_last memory format')
+parser.add_argument('--threads', type=int, default=0, help='Number of intra-op threads (with --cpu_optimize)')
+parser.add_argument('--quantize', action='store_true', help='Quantize the classifier Linear layers to int8 (CPU only)')
+parser.add_argument('--bf16', action='store_true', help='Run the forward passes under bfloat16 autocast, where the CPU supports it')
+parser.add_argument('--draft', action='store_true', help='Decode JPEGs downscaled: faster on large images, but not the full decode the model was trained on')
+
+args, _ = parser.parse_known_args()
+
+# ------------------------------------------------------------------
+# Collect concurrent requests into batches run in one forward pass
+# ------------------------------------------------------------------
+class MicroBatcher:
+    def __init__(self, buNN, device, names, channels_last=False, bf16=False, max_batch=16, max_wait_ms=5, stats_window=10000):
+        self.buNN = buNN
+        self.device = device
+        self.names = names
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.latencies = deque(maxlen=stats_window)    # seconds from request arrival to its answer, of the latest requests
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.model_seconds = 0.0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, image_tensor, k):
+        future = Future()
+        self.requests.put((image_tensor, k, future))
+        return future
+
+    def next_batch(self):
+        # Block for the first request, then take whatever else arrives within max_wait
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                model_start = time.time()
+                images = image_processor.normalize(torch.stack([image for image, _, _ in batch]).to(self.device))
+                images = to_device(images, self.device, self.channels_last)
+                with torch.inference_mode(), autocast(self.device, self.bf16):
+                    logps = self.buNN(images)
+                max_k = max(k for _, k, _ in batch)
+                top_ps, top_classes = torch.exp(logps.float()).topk(min(max_k, logps.shape[1]), dim=1)
+                model_seconds = time.time() - model_start
+
+                for (_, k, future), image_ps, image_classes in zip(batch, top_ps.tolist(), top_classes.tolist()):
+                    future.set_result({'classes': [self.names[c] for c in image_classes[:k]],
+                                       'probabilities': image_ps[:k]})
+                with self.lock:
+                    self.batch_sizes.append(len(batch))
+                    self.num_batches += 1
+                    self.model_seconds += model_seconds
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_requests += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)    # at most stats_window of them
+            batch_sizes = list(self.batch_sizes)
+            num_requests, num_batches = self.num_requests, self.num_batches
+            model_seconds = self.model_seconds
+        uptime = time.time() - self.started
+
+        def percentile(p):
+            return 1000 * latencies[min(int(p * len(latencies)), len(latencies) - 1)] if latencies else None
+
+        return {
+            'requests': num_requests,
+            'batches': num_batches,
+            'mean_batch_size': sum(batch_sizes) / len(batch_sizes) if batch_sizes else None,
+            'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99)},
+            'model_seconds': model_seconds,
+            'uptime_seconds': uptime,
+            'requests_per_second': num_requests / uptime,
+        }
+
+# ------------------------------------------------------------
+# HTTP interface: POST /predict with the image bytes, GET /stats
+# ------------------------------------------------------------
+class PredictionHandler(BaseHTTPRequestHandler):
+    batcher = None
+    image_processor = image_processor
+    default_k = 5
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/stats':
+            self.send_json(200, self.batcher.stats())
+        else:
+            self.send_json(404, {'error': 'GET /stats or POST /predict'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self.send_json(404, {'error': 'GET /stats or POST /predict'})
+            return
+        start = time.time()
+        try:
+            k = int(parse_qs(url.query).get('k', [self.default_k])[0])
+            if k < 1:
+                raise ValueError('k must be a positive integer, got {}'.format(k))
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            image_tensor = self.image_processor.load(io.BytesIO(body))    # decoded in this request's thread, in parallel with the others
+        except Exception as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            prediction = self.batcher.submit(image_tensor, k).result()
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.batcher.record(time.time() - start)
+        self.send_json(200, prediction)
+
+    def log_message(self, format, *args):
+        pass    # /stats replaces the per-request log lines
+
+# -----------------------------------------------
+# Load the model once and serve until interrupted
+# -----------------------------------------------
+def serve(checkpoint, labels='', host='127.0.0.1', port=8000, k=5, max_batch=16, max_wait_ms=5, gpu=False,
+          mmap=False, cpu_optimized=False, threads=0, quantize=False, bf16=False, runtime='eager', stats_window=10000, draft=False):
+    if not checkpoint:
+        raise ValueError('Please pass Model Checkpoint using --checkpoint')
+    if k < 1:
+        raise ValueError('--k must be a positive integer')
+
+    device = inference_device(gpu, runtime)
+    buNN, channels_last, bf16 = prepare_model(checkpoint, device, cpu_optimized=cpu_optimized, threads=threads,
+                                              quantize=quantize, bf16=bf16, mmap=mmap, runtime=runtime)
+    PredictionHandler.batcher = MicroBatcher(buNN, device, class_names(buNN.class_to_idx, labels), channels_last=channels_last,
+                                             bf16=bf16, max_batch=max_batch, max_wait_ms=max_wait_ms, stats_window=stats_window)
+    PredictionHandler.image_processor = ImageProcessor(draft=draft)
+    PredictionHandler.default_k = k
+
+    server = ThreadingHTTPServer((host, port), PredictionHandler)
+    print('Serving {} on http://{}:{}\tPOST /predict?k={}\tGET /stats'.format(checkpoint, host, port, k))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# ---------------------------------
+# Execute serve() from command line
+# ---------------------------------
+if __name__ == '__main__':
+    serve(args.checkpoint, labels=args.labels, host=args.host, port=args.port, k=args.k, max_batch=args.max_batch,
+          max_wait_ms=args.max_wait_ms, gpu=args.gpu, mmap=args.mmap, cpu_optimized=args.cpu_optimize,
+          threads=args.threads, quantize=args.quantize, bf16=args.bf16, runtime=args.runtime, stats_window=args.stats_window,
+          draft=args.draft)
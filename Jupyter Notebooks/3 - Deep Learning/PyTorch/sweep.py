@@ -0,0 +1,130 @@
+import torch
+
+import train
+
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import multiprocessing as mp
+import os
+import time
+
+# -----------------------------
+# Define command line Arguments
+# -----------------------------
+parser = argparse.ArgumentParser(allow_abbrev=False)
+parser.add_argument('--data_dir', type=str, help='Path to data set')
+parser.add_argument('--feature_cache', type=str, default='feature_cache', help='Directory of the bottleneck features shared by all trials')
+parser.add_argument('--arch', type=str, nargs='+', default=['alexnet'], help='Model architectures to try')
+parser.add_argument('--h1_units', type=int, nargs='+', default=[512], help='Hidden layer 1 sizes to try')
+parser.add_argument('--h2_units', type=int, nargs='+', default=[256], help='Hidden layer 2 sizes to try')
+parser.add_argument('--dropout', type=float, nargs='+', default=[0.2], help='Dropout rates to try')
+parser.add_argument('--learning_rate', type=float, nargs='+', default=[0.001], help='Learning rates to try')
+parser.add_argument('--epochs', type=int, default=5, help='Number of epochs per trial')
+parser.add_argument('--batch_size', type=int, default=64, help='Number of images per batch')
+parser.add_argument('--seed', type=int, default=0, help='Seed shared by all trials, so they only differ by their hyper-parameters')
+parser.add_argument('--jobs', type=int, default=0, help='Number of trials run in parallel (default is one per core)')
+parser.add_argument('--threads', type=int, default=0, help='Number of PyTorch threads per trial (default is the cores divided by --jobs)')
+parser.add_argument('--results', type=str, default='sweep_results.csv', help='CSV file receiving the results table')
+
+args, _ = parser.parse_known_args()
+
+RESULT_COLUMNS = ['arch', 'h1_units', 'h2_units', 'dropout', 'learning_rate', 'valid_loss', 'valid_accuracy',
+                  'test_loss', 'test_accuracy', 'seconds_per_epoch']
+
+# ----------------------------------------------------------------
+# Cache the bottleneck features of every architecture, only once
+# ----------------------------------------------------------------
+def cache_all_features(data_dir, archs, feature_cache):
+    # Without augmentation, all three data sets are cached and the trials never run the backbones
+    image_datasets = train.process_images(data_dir, augment=False)
+    features = {}
+    for arch in archs:
+        features[arch] = {x: train.feature_files(arch, x, image_datasets[x], feature_cache) for x in list(image_datasets.keys())}
+        if not all(os.path.exists(path) for files in features[arch].values() for path in files):
+            buNN = train.load_model(arch=arch, num_outputs=len(image_datasets['train'].classes))
+            for x in list(image_datasets.keys()):
+                train.cache_features(buNN, arch, x, image_datasets[x], feature_cache, torch.device('cpu'))
+
+    # The trials only get the feature files and the classes: they load neither the images nor the backbone
+    return features, image_datasets['train'].class_to_idx
+
+# ----------------------------------
+# Run one trial in a worker process
+# ----------------------------------
+def init_worker(threads):
+    # Each worker gets its share of the cores, so parallel trials don't oversubscribe them
+    torch.set_num_threads(threads)
+    train.args = train.parser.parse_args([])    # only the trial's parameters, not the sweep's command line
+
+def run_trial(trial):
+    arch, h1_units, h2_units, dropout, learning_rate, features, options = trial
+    with contextlib.redirect_stdout(io.StringIO()):    # keep the per-epoch output of the trials out of the table
+        buNN = train.train_model(arch=arch, h1_units=h1_units, h2_units=h2_units, dropout=dropout, learning_rate=learning_rate,
+                                 augment=False, valid_every=0, features=features[arch], **options)
+    results = buNN.results
+    last = results['history'][-1]
+
+    return {
+        'arch': arch, 'h1_units': h1_units, 'h2_units': h2_units, 'dropout': dropout, 'learning_rate': learning_rate,
+        'valid_loss': last['valid_loss'], 'valid_accuracy': last['valid_accuracy'],
+        'test_loss': results['test_loss'], 'test_accuracy': results['test_accuracy'],
+        'seconds_per_epoch': sum(results['epoch_seconds']) / len(results['epoch_seconds'])
+    }
+
+# -------------------------------------------------------------
+# Try every combination of hyper-parameters, and tabulate them
+# -------------------------------------------------------------
+def sweep(data_dir, archs, h1_units, h2_units, dropouts, learning_rates, epochs=5, batch_size=64, seed=0,
+          feature_cache='feature_cache', jobs=0, threads=0, results_file='sweep_results.csv'):
+    if not data_dir:
+        raise ValueError('Please pass Data Directory using --data_dir')
+    train.args = train.parser.parse_args([])
+
+    cores = os.cpu_count() or 1
+    jobs = jobs or cores
+    threads = threads or max(1, cores // jobs)
+
+    cache_start = time.time()
+    features, class_to_idx = cache_all_features(data_dir, archs, feature_cache)
+    print('Features cached in {:.1f}s'.format(time.time() - cache_start))
+
+    options = {'epochs': epochs, 'batch_size': batch_size, 'seed': seed, 'class_to_idx': class_to_idx}
+    trials = [trial + (features, options) for trial in itertools.product(archs, h1_units, h2_units, dropouts, learning_rates)]
+    print('{} trials\t{} jobs\t{} threads per job'.format(len(trials), jobs, threads))
+
+    # Spawned workers start from a clean interpreter rather than a fork of this one's PyTorch thread pools
+    sweep_start = time.time()
+    results = []
+    with mp.get_context('spawn').Pool(jobs, initializer=init_worker, initargs=(threads,)) as pool:
+        for result in pool.imap_unordered(run_trial, trials):
+            results.append(result)
+            print('{}/{}\t{arch} h1={h1_units} h2={h2_units} dropout={dropout} lr={learning_rate}\t'
+                  'valid accuracy={valid_accuracy:.3f}'.format(len(results), len(trials), **result))
+    print('Sweep ran in {:.1f}s'.format(time.time() - sweep_start))
+
+    # Best validation accuracy first
+    results.sort(key=lambda result: -result['valid_accuracy'])
+    print('\n' + ''.join('{:>18}'.format(column) for column in RESULT_COLUMNS))
+    for result in results:
+        print(''.join('{:>18.4g}'.format(result[c]) if isinstance(result[c], float) else '{:>18}'.format(result[c])
+                      for c in RESULT_COLUMNS))
+
+    if results_file:
+        with open(results_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(results)
+        print('Results written to {}'.format(results_file))
+
+    return results
+
+# ---------------------------------
+# Execute sweep() from command line
+# ---------------------------------
+if __name__ == '__main__':
+    sweep(args.data_dir, args.arch, args.h1_units, args.h2_units, args.dropout, args.learning_rate, epochs=args.epochs,
+          batch_size=args.batch_size, seed=args.seed, feature_cache=args.feature_cache, jobs=args.jobs, threads=args.threads,
+          results_file=args.results)
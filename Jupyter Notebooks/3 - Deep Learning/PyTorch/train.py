@@ -2,26 +2,48 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.utils.data as data
+import numpy as np
 
 from collections import OrderedDict
 
 from torchvision import datasets, transforms, models
+from PIL import Image
 
 import argparse
+import hashlib
+import os
+import random
+import time
 
 # -----------------------------
 # Define command line Arguments
 # -----------------------------
-parser = argparse.ArgumentParser()
+parser = argparse.ArgumentParser(allow_abbrev=False)    # no prefix matching of the arguments meant for predict.py and the others
 parser.add_argument('--arch', type=str, help='Model architecture')
 parser.add_argument('--checkpoint', type=str, help='File for saving trained model checkpoint')
 parser.add_argument('--data_dir', type=str, help='Path to data set')
-parser.add_argument('--dropout', type=int, help='Dropout rate (between 0 and 1)')
+parser.add_argument('--dropout', type=float, help='Dropout rate (between 0 and 1)')
 parser.add_argument('--epochs', type=int, help='Number of epochs')
 parser.add_argument('--gpu', action='store_true', help='Use GPU if available')
 parser.add_argument('--h1_units', type=int, help='Number of hidden units for layer 1')
 parser.add_argument('--h2_units', type=int, help='Number of hidden units for layer 2')
 parser.add_argument('--learning_rate', type=float, help='Learning rate')
+parser.add_argument('--feature_cache', type=str, help='Directory caching the frozen backbone features of the valid/test (and un-augmented train) images')
+parser.add_argument('--no_augment', action='store_true', help='Train on un-augmented images, which also lets the train features be cached')
+parser.add_argument('--batch_size', type=int, help='Number of images per batch')
+parser.add_argument('--workers', type=int, help='Number of DataLoader worker processes decoding and transforming images')
+parser.add_argument('--prefetch', type=int, help='Number of batches each worker loads ahead')
+parser.add_argument('--valid_every', type=int, help='Validate every N training steps (default 20); 0 validates once at the end of each epoch')
+parser.add_argument('--valid_batches', type=int, help='Validate on a fixed random sample of N batches of the validation set')
+parser.add_argument('--image_cache', type=str, help='Directory caching the decoded images, resized to 256px, in one memory-mapped file per data set')
+parser.add_argument('--draft', action='store_true', help='Decode JPEGs downscaled into the --image_cache: faster, but not the full decode predict.py uses by default')
+parser.add_argument('--cpu_optimize', action='store_true', help='Tune for CPU: thread pools, channels_last memory format and inference mode')
+parser.add_argument('--threads', type=int, help='Number of intra-op threads (with --cpu_optimize; default is all cores)')
+parser.add_argument('--interop_threads', type=int, help='Number of inter-op threads (with --cpu_optimize)')
+parser.add_argument('--save_every', type=int, help='Also save a resumable --checkpoint every N training steps (one is always saved after each epoch)')
+parser.add_argument('--resume', action='store_true', help='Resume training from the --checkpoint file, if it exists')
+parser.add_argument('--seed', type=int, help='Seed of the shuffling, initialization and dropout (default is random, and saved in the checkpoint)')
+parser.add_argument('--bf16', action='store_true', help='Run forward passes under bfloat16 autocast, where the CPU supports it')
 
 args, _ = parser.parse_known_args()
 print('args: {}'.format(args))
@@ -29,13 +51,13 @@ print('args: {}'.format(args))
 # ------------------------
 # Load and configure Model
 # ------------------------
-def load_model(arch='vgg16_bn', num_outputs=102, num_h1=512, num_h2=256, dropout=0.2):
-    # Load pre-trained Model
+def load_model(arch='vgg16_bn', num_outputs=102, num_h1=512, num_h2=256, dropout=0.2, pretrained=True):
+    # Load pre-trained Model, or only its architecture when the weights come from a checkpoint
     if arch=='vgg16_bn':
-        buNN = models.vgg16_bn(pretrained=True)
+        buNN = models.vgg16_bn(pretrained=pretrained)
         num_inputs = 25088
     elif arch=='alexnet':
-        buNN = models.alexnet(pretrained=True)
+        buNN = models.alexnet(pretrained=pretrained)
         num_inputs = 9216
     else:
         raise ValueError('NN architecture only accepts vgg16_bn and alexnet, not ', arch)
@@ -58,11 +80,119 @@ def load_model(arch='vgg16_bn', num_outputs=102, num_h1=512, num_h2=256, dropout
 
     return buNN
 
+# ------------------------------------
+# Tune PyTorch for CPU-only hardware
+# ------------------------------------
+def cpu_optimize(buNN, threads=0, interop_threads=0):
+    # Size the intra-op (within one operator) and inter-op (across independent operators) thread pools
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            print('Inter-op threads can only be set before the first parallel operation, keeping {}'.format(
+                torch.get_num_interop_threads()))
+
+    # channels_last (NHWC) lets oneDNN run the convolutions without reordering their inputs
+    return buNN.to(memory_format=torch.channels_last)
+
+def to_device(images, device, channels_last=False):
+    images = images.to(device, non_blocking=True)
+    if channels_last and images.dim() == 4:    # only image batches, not cached feature vectors
+        images = images.contiguous(memory_format=torch.channels_last)
+    return images
+
+def bf16_supported():
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+def autocast(device, bf16=False):
+    # bfloat16 autocast halves the memory traffic of the forward pass; a no-op when disabled
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=bf16)
+
+def quantize_classifier(buNN):
+    # Dynamic int8 quantization of the classifier's Linear layers: weights are stored as int8 and
+    # activations quantized on the fly. Inference only, as quantized layers can't be trained
+    buNN.classifier = torch.ao.quantization.quantize_dynamic(buNN.classifier, {nn.Linear}, dtype=torch.qint8)
+    return buNN
+
+# ---------------------------------------------------------------
+# Cache the decoded, resized images in one memory-mapped file
+# ---------------------------------------------------------------
+CACHE_SIZE = 256    # the Resize(256) used before cropping, so the cache keeps everything the crops need
+
+def draft_loader(path):
+    # Let the JPEG decoder scale down while decoding, keeping at least CACHE_SIZE pixels on each side
+    with open(path, 'rb') as f:
+        image = Image.open(f)
+        image.draft('RGB', (CACHE_SIZE, CACHE_SIZE))
+        return image.convert('RGB')
+
+class CachedImageDataset(data.Dataset):
+    # Same interface as ImageFolder, but the images come from the uint8 cache written by cache_images
+    def __init__(self, images_file, labels_file, image_folder, transform=None, draft=False):
+        self.images_file = images_file
+        self.draft = draft
+        self.labels = np.load(labels_file)
+        self.transform = transform
+        self.classes = image_folder.classes
+        self.class_to_idx = image_folder.class_to_idx
+        self.samples = image_folder.samples
+        self.images = None    # opened lazily, so each DataLoader worker maps the file instead of pickling it
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.images = np.load(self.images_file, mmap_mode='r')
+        image = Image.fromarray(self.images[index])
+        if self.transform is not None:
+            image = self.transform(image)
+
+        return image, int(self.labels[index])
+
+def cache_images(images_directory, cache_dir, transform=None, workers=0, draft=False):
+    # Decode and resize every image once: shorter side to CACHE_SIZE, then a centered CACHE_SIZE square.
+    # Draft decoding is faster on large JPEGs, but its pixels differ from those of the full decode
+    loader = draft_loader if draft else datasets.folder.default_loader
+    image_folder = datasets.ImageFolder(images_directory, loader=loader, transform=transforms.Compose([
+        transforms.Resize(CACHE_SIZE),
+        transforms.CenterCrop(CACHE_SIZE),
+        transforms.PILToTensor()
+    ]))
+    images_hash = hashlib.md5(str(image_folder.samples).encode()).hexdigest()[:12]
+    name = os.path.basename(os.path.normpath(images_directory))
+    name += '_draft' if draft else '_full'    # caches from before draft decoding was optional were draft decoded
+    images_file = os.path.join(cache_dir, '{}_{}_images.npy'.format(name, images_hash))
+    labels_file = os.path.join(cache_dir, '{}_{}_labels.npy'.format(name, images_hash))
+
+    if not (os.path.exists(images_file) and os.path.exists(labels_file)):
+        os.makedirs(cache_dir, exist_ok=True)
+        images = np.lib.format.open_memmap(images_file + '.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(image_folder), CACHE_SIZE, CACHE_SIZE, 3))
+        labels = np.zeros(len(image_folder), dtype=np.int64)
+
+        start = 0
+        for batch_images, batch_labels in data.DataLoader(image_folder, batch_size=64, shuffle=False, num_workers=workers):
+            end = start + len(batch_labels)
+            images[start:end] = batch_images.permute(0, 2, 3, 1).numpy()    # channels last, as PIL expects
+            labels[start:end] = batch_labels.numpy()
+            start = end
+
+        images.flush()
+        del images
+        np.save(labels_file, labels)
+        os.replace(images_file + '.tmp', images_file)    # only a complete cache gets the final name
+        print('Cached {} images of {} in {}'.format(len(image_folder), images_directory, images_file))
+
+    return CachedImageDataset(images_file, labels_file, image_folder, transform=transform, draft=draft)
+
 # ----------------------------------------
 # Process the Image data sets for training
 # ----------------------------------------
-def process_images(images_directory):
-    if args.data_dir:
+def process_images(images_directory, augment=True, image_cache='', workers=0, draft=False):
+    if images_directory:
         # Define transforms for training, validation, and testing data sets
         image_transforms = {
             'train': transforms.Compose([
@@ -71,6 +201,11 @@ def process_images(images_directory):
                 transforms.RandomHorizontalFlip(),
                 transforms.ToTensor(),
                 transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+             ]) if augment else transforms.Compose([
+                transforms.Resize(256),
+                transforms.CenterCrop(224),
+                transforms.ToTensor(),
+                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
              ]),
             'valid': transforms.Compose([
                 transforms.Resize(256),
@@ -86,17 +221,216 @@ def process_images(images_directory):
              ])
         }
 
-        # Load the data sets using ImageFolder
-        image_datasets = {
-            x: datasets.ImageFolder(args.data_dir + '/' + x, transform=image_transforms[x]) for x in list(image_transforms.keys())
-        }
+        # Load the data sets using ImageFolder, or from the decoded image cache
+        if image_cache:
+            image_datasets = {
+                x: cache_images(images_directory + '/' + x, image_cache, transform=image_transforms[x], workers=workers,
+                                draft=draft) for x in list(image_transforms.keys())
+            }
+        else:
+            image_datasets = {
+                x: datasets.ImageFolder(images_directory + '/' + x, transform=image_transforms[x]) for x in list(image_transforms.keys())
+            }
 
         return image_datasets
 
+# ----------------------------------------------
+# Create the data loaders for the image data sets
+# ----------------------------------------------
+class EpochSampler(data.Sampler):
+    # Shuffles with a generator seeded by the epoch, so a resumed run replays the same order
+    # and can start in the middle of an epoch without loading the batches it skips.
+    # With with_epoch, it yields (epoch, index) pairs for a SeededDataset
+    def __init__(self, data_source, seed=0, with_epoch=False):
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.with_epoch = with_epoch
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.num_samples, generator=generator)[self.start:].tolist()
+        return iter([(self.epoch, index) for index in indices] if self.with_epoch else indices)
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+class SeededDataset(data.Dataset):
+    # Seeds the random augmentation of each image from the run's seed, the epoch and the image index,
+    # whichever worker loads it: a resumed run, with any number of workers, augments every image the same way.
+    # The RNG is forked, so that loading in the main process leaves the global RNG to dropout
+    def __init__(self, dataset, seed=0):
+        self.dataset = dataset
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, epoch_index):
+        epoch, index = epoch_index
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed + epoch * len(self.dataset) + index)
+            return self.dataset[index]
+
+def create_dataloaders(image_datasets, batch_size=64, workers=0, prefetch=2, pin_memory=False, seed=0, valid_batches=None):
+    dataloaders = {}
+    for x in list(image_datasets.keys()):
+        # The validation set is sorted by class, so a shorter validation runs on a seeded random sample of it,
+        # drawn once: every validation of the training sees the same images
+        dataset = image_datasets[x]
+        if x == 'valid' and valid_batches and valid_batches * batch_size < len(dataset):
+            sample_generator = torch.Generator()
+            sample_generator.manual_seed(seed)
+            indices = torch.randperm(len(dataset), generator=sample_generator)[:valid_batches * batch_size]
+            dataset = data.Subset(dataset, indices.sort().values.tolist())    # in file order, for the memory maps
+
+        # Only images need decoding in workers; cached feature tensors are simply sliced
+        loader_options = {}
+        images = not isinstance(image_datasets[x], data.TensorDataset)
+        if workers > 0 and images:
+            loader_options = {'num_workers': workers, 'prefetch_factor': prefetch, 'persistent_workers': True}
+
+        # Only the training set needs shuffling, and seeding of its augmentation
+        sampler = None
+        if x == 'train':
+            if images:
+                dataset = SeededDataset(dataset, seed=seed)
+            sampler = EpochSampler(dataset, seed=seed, with_epoch=images)
+        # Each loader draws its worker seeds from its own generator, leaving the global RNG to dropout,
+        # so that restoring the global RNG state resumes a training exactly
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        dataloaders[x] = data.DataLoader(dataset, batch_size=batch_size, sampler=sampler, generator=generator,
+                                         pin_memory=pin_memory, **loader_options)
+
+    return dataloaders
+
+def print_throughput(stage_images, stage_seconds):
+    for x in list(stage_images.keys()):
+        if stage_seconds[x] > 0:
+            print(f'{x.capitalize()}: {stage_images[x]} images in {stage_seconds[x]:.1f}s = {stage_images[x]/stage_seconds[x]:.1f} images/second')
+
+# ----------------------------------------------------------
+# Cache the bottleneck features of the frozen backbone trunk
+# ----------------------------------------------------------
+def extract_features(buNN, images):
+    # Everything the model does before its classifier; the trunk is frozen so this never changes
+    features = buNN.features(images)
+    if hasattr(buNN, 'avgpool'):
+        features = buNN.avgpool(features)
+
+    return torch.flatten(features, 1)    # unlike view(), also works on channels_last features
+
+def feature_files(arch, split, image_dataset, cache_dir):
+    # The cache file name depends on the architecture, the exact list of images and where their pixels come from:
+    # the resizing of the image cache, and its draft decoding, change the features a little
+    images_hash = hashlib.md5(str(image_dataset.samples).encode()).hexdigest()[:12]
+    source = 'raw'
+    if isinstance(image_dataset, CachedImageDataset):
+        source = 'cached_draft' if image_dataset.draft else 'cached_full'
+    features_file = os.path.join(cache_dir, '{}_{}_{}_{}_features.npy'.format(arch, split, source, images_hash))
+    labels_file = os.path.join(cache_dir, '{}_{}_{}_{}_labels.npy'.format(arch, split, source, images_hash))
+
+    return features_file, labels_file
+
+def load_features(features_file, labels_file):
+    # Copy-on-write memory map: the features are paged in from disk as the batches need them
+    features = torch.from_numpy(np.load(features_file, mmap_mode='c'))
+    labels = torch.from_numpy(np.load(labels_file))
+
+    return data.TensorDataset(features, labels)
+
+def cache_features(buNN, arch, split, image_dataset, cache_dir, device, batch_size=64):
+    features_file, labels_file = feature_files(arch, split, image_dataset, cache_dir)
+
+    # Run the trunk over the data set only once, straight into a memory-mapped file
+    if not (os.path.exists(features_file) and os.path.exists(labels_file)):
+        os.makedirs(cache_dir, exist_ok=True)
+        num_inputs = buNN.classifier.inputs.in_features
+        features = np.lib.format.open_memmap(features_file + '.tmp', mode='w+', dtype=np.float32,
+                                             shape=(len(image_dataset), num_inputs))
+        labels = np.zeros(len(image_dataset), dtype=np.int64)
+
+        buNN.eval()
+        start = 0
+        with torch.no_grad():
+            for images, batch_labels in data.DataLoader(image_dataset, batch_size=batch_size, shuffle=False):
+                end = start + len(batch_labels)
+                features[start:end] = extract_features(buNN, images.to(device)).cpu().numpy()
+                labels[start:end] = batch_labels.numpy()
+                start = end
+        buNN.train()
+
+        features.flush()
+        del features
+        np.save(labels_file, labels)
+        os.replace(features_file + '.tmp', features_file)    # only a complete cache gets the final name
+        print('Cached {} {} features in {}'.format(len(image_dataset), split, features_file))
+
+    return load_features(features_file, labels_file)
+
+# ------------------------------------------------
+# Save and restore the state of a training run
+# ------------------------------------------------
+def save_checkpoint(checkpoint_data, checkpoint):
+    # Write to a temporary file first: a crash while saving can't corrupt the previous checkpoint
+    torch.save(checkpoint_data, checkpoint + '.tmp')
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+def get_rng_state():
+    # Plain lists and tensors only, so the checkpoint still loads with weights_only=True
+    numpy_state = np.random.get_state()
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': [numpy_state[0], numpy_state[1].tolist(), numpy_state[2], numpy_state[3], numpy_state[4]],
+        'python': random.getstate()
+    }
+
+def set_rng_state(rng_state):
+    torch.set_rng_state(rng_state['torch'])
+    if rng_state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+    name, keys, position, has_gauss, cached_gaussian = rng_state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), position, has_gauss, cached_gaussian))
+    version, internal_state, gauss_next = rng_state['python']
+    random.setstate((version, tuple(internal_state), gauss_next))
+
+# -------------------------------------------
+# Measure the loss and accuracy on a data set
+# -------------------------------------------
+def evaluate_model(buNN, forward, dataloader, criterion, device, channels_last=False, bf16=False):
+    buNN.eval()    # put the model in inference/evaluation/prediction mode and turn off dropout
+    loss_sum = torch.zeros((), device=device)    # accumulate on the device, read back once at the end
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    num_images = 0
+
+    with torch.inference_mode():    # no gradients, and no autograd bookkeeping either, when making predictions
+        for images, labels in dataloader:
+            images, labels = to_device(images, device, channels_last), labels.to(device, non_blocking=True)    # move data to device
+            with autocast(device, bf16):
+                logps = forward(images)
+            loss_sum += criterion(logps.float(), labels) * len(labels)
+            correct += (logps.argmax(dim=1) == labels).sum()    # the top class of the log softmax is the top class
+            num_images += len(labels)
+
+    buNN.train()    # put the model back into training mode
+
+    return (loss_sum / num_images).item(), (correct.double() / num_images).item(), num_images
+
 # -----------
 # Train Model
 # -----------
-def train_model(arch='vgg16_bn', checkpoint='', dropout=0.2, epochs=10, gpu=False, h1_units=512, h2_units=256, learning_rate=0.001):
+def train_model(arch='vgg16_bn', checkpoint='', dropout=0.2, epochs=10, gpu=False, h1_units=512, h2_units=256, learning_rate=0.001,
+                feature_cache='', augment=True, batch_size=64, workers=0, prefetch=2, image_cache='', draft=False, valid_every=20, valid_batches=None,
+                cpu_optimized=False, threads=0, interop_threads=0, bf16=False, save_every=0, resume=False, seed=None, data_dir='',
+                features=None, class_to_idx=None):
     # Read command line arguments
     if args.arch:
         arch = args.arch
@@ -114,127 +448,252 @@ def train_model(arch='vgg16_bn', checkpoint='', dropout=0.2, epochs=10, gpu=Fals
         h2_units = args.h2_units
     if args.learning_rate:
         learning_rate = args.learning_rate
+    if args.feature_cache:
+        feature_cache = args.feature_cache
+    if args.no_augment:
+        augment = False
+    if args.batch_size:
+        batch_size = args.batch_size
+    if args.workers:
+        workers = args.workers
+    if args.prefetch:
+        prefetch = args.prefetch
+    if args.image_cache:
+        image_cache = args.image_cache
+    if args.draft:
+        draft = True
+    if args.valid_every is not None:
+        valid_every = args.valid_every
+    if args.valid_batches:
+        valid_batches = args.valid_batches
+    if args.cpu_optimize:
+        cpu_optimized = True
+    if args.threads:
+        threads = args.threads
+    if args.interop_threads:
+        interop_threads = args.interop_threads
+    if args.bf16:
+        bf16 = args.bf16
+    if args.save_every:
+        save_every = args.save_every
+    if args.resume:
+        resume = args.resume
+    if args.seed is not None:
+        seed = args.seed
+
+    # When resuming, the checkpoint's hyper-parameters win over the command line ones
+    resume_data = None
+    if resume and checkpoint and os.path.exists(checkpoint):
+        resume_data = torch.load(checkpoint, map_location='cpu', weights_only=True)
+        arch, dropout = resume_data['arch'], resume_data['dropout']
+        h1_units, h2_units = resume_data['h1_units'], resume_data['h2_units']
+        batch_size = resume_data.get('batch_size', batch_size)    # the resume offset counts batches of this size
+        seed = resume_data['seed']
+        print('Resuming from {} at epoch {}, batch {}'.format(checkpoint, resume_data['epoch'] + 1, resume_data['batch']))
+    elif resume:
+        print('No checkpoint to resume from, starting a new training')
+    if seed is None:
+        seed = random.randrange(2**31)
+    if resume_data is None:
+        # The seed also drives the classifier initialization and the dropout; a resumed run restores their RNG instead
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        random.seed(seed)
         
     print('Architecture: {}\tCheckpoint: {}\tDropout: {}\t{} Epochs\tGPU: {}\t{} H1 units\t{} H2 units\tLearning Rate: {}'.format(
         arch, checkpoint, dropout, epochs, gpu, h1_units, h2_units, learning_rate))
     
-    # Create the training, validation, and testing data loaders from the image data sets
+    # Create the training, validation, and testing image data sets
     if args.data_dir:
-        image_datasets = process_images(args.data_dir)
+        data_dir = args.data_dir
+    if features:
+        # The bottleneck features of every data set are already cached, e.g. by sweep.py: no images to scan
+        if checkpoint or not class_to_idx:
+            raise ValueError('Cached features need their class_to_idx, and give no backbone weights to checkpoint')
+        image_datasets = {x: load_features(*features[x]) for x in list(features.keys())}
+    elif data_dir:
+        image_datasets = process_images(data_dir, augment=augment, image_cache=image_cache, workers=workers, draft=draft)
+        class_to_idx = image_datasets['train'].class_to_idx
     else:
         raise ValueError('Please pass Data Directory using --data_dir')
-    dataloaders = {
-        x: data.DataLoader(image_datasets[x], batch_size=64, shuffle=True) for x in list(image_datasets.keys())
-    }
- 
-    # Calculate dataset sizes.
-    dataset_sizes = {
-        x: len(dataloaders[x]) for x in list(image_datasets.keys())
-    }
 
     # Load the model     
-    num_labels = len(image_datasets['train'].classes)
-    buNN = load_model(arch=arch, num_outputs=num_labels, num_h1=h1_units, num_h2=h2_units, dropout=dropout)
+    num_labels = len(class_to_idx)
+    if features:
+        # Only the classifier runs on the features: the backbone is built on the meta device, without any memory,
+        # and the classifier alone gets real, freshly initialized weights
+        with torch.device('meta'):
+            buNN = load_model(arch=arch, num_outputs=num_labels, num_h1=h1_units, num_h2=h2_units, dropout=dropout,
+                              pretrained=False)
+        buNN.classifier.to_empty(device='cpu')
+        for layer in buNN.classifier:
+            if isinstance(layer, nn.Linear):
+                layer.reset_parameters()
+    else:
+        buNN = load_model(arch=arch, num_outputs=num_labels, num_h1=h1_units, num_h2=h2_units, dropout=dropout,
+                          pretrained=(resume_data is None))    # a resumed model gets all its weights from the checkpoint
+    if resume_data is not None:
+        buNN.load_state_dict(resume_data['state'])
 
     # Use GPU if selected and available
     device = torch.device('cuda' if (gpu and torch.cuda.is_available()) else 'cpu')
-    buNN.to(device)
+    (buNN.classifier if features else buNN).to(device)
+    if cpu_optimized and device.type == 'cpu':
+        buNN = cpu_optimize(buNN, threads=threads, interop_threads=interop_threads)
+        print('CPU optimized: {} intra-op threads\t{} inter-op threads\tchannels_last'.format(
+            torch.get_num_threads(), torch.get_num_interop_threads()))
+    channels_last = cpu_optimized and device.type == 'cpu'
+    if bf16 and device.type == 'cpu' and not bf16_supported():
+        print('bfloat16 is not supported by this CPU, running in float32')
+        bf16 = False
 
+    # The backbone is frozen, so the data sets without random augmentation can be replaced by their cached
+    # bottleneck features, and only the classifier has to run on them
+    cached = list(image_datasets.keys()) if features else []
+    if feature_cache and not features:
+        cached = [x for x in list(image_datasets.keys()) if x != 'train' or not augment]
+        for x in cached:
+            image_datasets[x] = cache_features(buNN, arch, x, image_datasets[x], feature_cache, device)
+    forward = {
+        x: (buNN.classifier if x in cached else buNN) for x in list(image_datasets.keys())
+    }
+
+    # Create the training, validation, and testing data loaders
+    dataloaders = create_dataloaders(image_datasets, batch_size=batch_size, workers=workers, prefetch=prefetch,
+                                     pin_memory=(device.type == 'cuda'), seed=seed, valid_batches=valid_batches)
+ 
     # Define loss and optimizer
     criterion = nn.NLLLoss()
-    optimizer = optim.Adam(buNN.classifier.parameters(), lr=0.001)
+    optimizer = optim.Adam(buNN.classifier.parameters(), lr=learning_rate)
+    if resume_data is not None:
+        optimizer.load_state_dict(resume_data['optimizer'])
+
+    # Everything needed to save the model, or to resume its training after the given batch of the given epoch
+    def checkpoint_data(epoch, batch):
+        return {
+            'class_to_idx': class_to_idx,
+            'arch': arch,
+            'num_outputs': num_labels,
+            'h1_units': h1_units,
+            'h2_units': h2_units,
+            'dropout': dropout,
+            'batch_size': batch_size,
+            'state': buNN.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'epochs': epochs,
+            'epoch': epoch,
+            'batch': batch,
+            'steps': steps,
+            'seed': seed,
+            'rng': get_rng_state()
+        }
     
     # -----------------------------------
     # Train, validate, and test the model
     # -----------------------------------
     steps = 0    # training steps for each batch
+    start_epoch, start_batch = 0, 0
+    if resume_data is not None:
+        steps, start_epoch, start_batch = resume_data['steps'], resume_data['epoch'], resume_data['batch']
+        set_rng_state(resume_data['rng'])
     running_loss = 0
-    print_every = 20
+    running_steps = 0
+    stage_images = {x: 0 for x in list(image_datasets.keys())}    # images processed and wall-clock seconds per stage
+    stage_seconds = {x: 0.0 for x in list(image_datasets.keys())}
+    history = []    # one entry per validation
+    epoch_seconds = []
+
+    def validate(epoch):
+        nonlocal running_loss, running_steps
+        valid_start = time.time()
+        valid_loss, valid_accuracy, num_images = evaluate_model(buNN, forward['valid'], dataloaders['valid'], criterion, device,
+                                                                channels_last=channels_last, bf16=bf16)
+        stage_images['valid'] += num_images
+        stage_seconds['valid'] += time.time() - valid_start
+
+        print(f'Epoch {epoch+1}/{epochs}\t'
+              f'Train Loss = {running_loss/max(running_steps, 1):.3f}\t'
+              f'Validation Loss = {valid_loss:.3f}\t'
+              f'Validation Accuracy = {valid_accuracy:.3f}')
+        history.append({'epoch': epoch + 1, 'steps': steps, 'train_loss': running_loss/max(running_steps, 1),
+                        'valid_loss': valid_loss, 'valid_accuracy': valid_accuracy})
+
+        running_loss = 0
+        running_steps = 0
     
     # TRAIN
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
+        epoch_start, valid_seconds = time.time(), stage_seconds['valid']
+        dataloaders['train'].sampler.set_epoch(epoch, start=start_batch * batch_size)    # skip what a resumed run already trained on
+        batch, start_batch = start_batch, 0
         for train_images, train_labels in dataloaders['train']:
             steps += 1
-            train_images, train_labels = train_images.to(device), train_labels.to(device)    # move data tensor batches to device
+            batch += 1
+            stage_images['train'] += len(train_labels)
+            train_images, train_labels = to_device(train_images, device, channels_last), train_labels.to(device, non_blocking=True)    # move data tensor batches to device
             optimizer.zero_grad()    # reinitialize the classifier's gradients
-            logps = buNN.forward(train_images)    # same as writing buNN(train_images)
-            loss = criterion(logps, train_labels)
+            with autocast(device, bf16):
+                logps = forward['train'](train_images)    # same as writing buNN(train_images), or buNN.classifier on cached features
+            loss = criterion(logps.float(), train_labels)
             loss.backward()
             optimizer.step()
             running_loss += loss.item()
+            running_steps += 1
 
             # VALIDATE
-            # Every "print_every" training loops, test our accuracy and loss on the validation data set
-            if steps % print_every == 0:
-                buNN.eval()    # put the model in inference/evaluation/prediction mode and turn off dropout
-                valid_loss = 0
-                accuracy = 0
-
-                with torch.no_grad():    # no need to calculate gradients when making predictions
-                    for valid_images, valid_labels in dataloaders['valid']:
-                        valid_images, valid_labels = valid_images.to(device), valid_labels.to(device)    # move validation data to device
-                        logps = buNN.forward(valid_images)
-                        loss = criterion(logps, valid_labels)
-                        valid_loss += loss.item()
-
-                        # Calculate accuracy
-                        ps = torch.exp(logps)    # apply exp() because model returns log softmax
-                        top_ps, top_class = ps.topk(1, dim=1)
-                        equality = (top_class == valid_labels.view(*top_class.shape))
-                        accuracy += torch.mean(equality.type(torch.FloatTensor))    # sum accuracy for each batch
-
-                print(f'Epoch {epoch+1}/{epochs}\t'
-                      f'Train Loss = {running_loss/print_every:.3f}\t'
-                      f'Validation Loss = {valid_loss/dataset_sizes["valid"]:.3f}\t'
-                      f'Validation Accuracy = {accuracy/dataset_sizes["valid"]:.3f}')
-
-                running_loss = 0
-                buNN.train()    # put the model back into training mode before the next training loop
+            # Every "valid_every" training loops, test our accuracy and loss on the validation data set
+            if valid_every and steps % valid_every == 0:
+                validate(epoch)
+
+            # Save a resumable checkpoint every "save_every" training steps
+            if checkpoint and save_every and steps % save_every == 0:
+                save_checkpoint(checkpoint_data(epoch, batch), checkpoint)
+
+        # With no step schedule, validate once at the end of each epoch
+        if not valid_every:
+            validate(epoch)
+
+        # Training time is the epoch time less the validations that ran during it
+        epoch_valid_seconds = stage_seconds['valid'] - valid_seconds
+        stage_seconds['train'] += time.time() - epoch_start - epoch_valid_seconds
+        epoch_seconds.append(time.time() - epoch_start)
+        print(f'Epoch {epoch+1}/{epochs}\tTraining time = {time.time() - epoch_start - epoch_valid_seconds:.1f}s\t'
+              f'Validation time = {epoch_valid_seconds:.1f}s')
+
+        # Save a resumable checkpoint after each epoch but the last, saved below
+        if checkpoint and epoch + 1 < epochs:
+            save_checkpoint(checkpoint_data(epoch + 1, 0), checkpoint)
     print("End of Training")
     
     # TEST
-    buNN.eval()    # put the model in inference/evaluation/prediction mode and turn off dropout
-    test_loss = 0
-    accuracy = 0
-
-    with torch.no_grad():    # no need to calculate gradients when making predictions
-        for test_images, test_labels in dataloaders['test']:
-            test_images, test_labels = test_images.to(device), test_labels.to(device)    # move test data to device
-            logps = buNN.forward(test_images)
-            loss = criterion(logps, test_labels)
-            test_loss += loss.item()
-
-            # Calculate accuracy
-            ps = torch.exp(logps)    # apply exp() because model returns log softmax
-            top_ps, top_class = ps.topk(1, dim=1)
-            equality = (top_class == test_labels.view(*top_class.shape))
-            accuracy += torch.mean(equality.type(torch.FloatTensor))    # sum accuracy for each batch
+    test_start = time.time()
+    test_loss, test_accuracy, stage_images['test'] = evaluate_model(buNN, forward['test'], dataloaders['test'], criterion, device,
+                                                                   channels_last=channels_last, bf16=bf16)
+    stage_seconds['test'] += time.time() - test_start
 
-    buNN.train()    # put the model back into training mode
-
-    print(f'Test Loss = {test_loss/dataset_sizes["test"]:.3f}.. '
-          f'Test Accuracy = {accuracy/dataset_sizes["test"]:.3f}')
+    print_throughput(stage_images, stage_seconds)
+    print(f'Test Loss = {test_loss:.3f}.. '
+          f'Test Accuracy = {test_accuracy:.3f}')
     
-    # If requested, save the checkpoint
+    # If requested, save the checkpoint: tensors and plain values only, so it loads with weights_only=True,
+    # and the hyper-parameters rebuild the classifier with load_model() instead of unpickling it
     if checkpoint:
-        checkpoint_data = {
-            'class_to_idx': image_datasets['train'].class_to_idx,
-            'arch': arch,
-            'state': buNN.state_dict(),
-            'classifier': buNN.classifier,
-            'optimizer': optimizer.state_dict(),
-            'epochs': epochs
-        }
-
-        torch.save(checkpoint_data, checkpoint)
+        save_checkpoint(checkpoint_data(epochs, 0), checkpoint)
     
-    # Return the model
+    # Return the model, with the history of its training and test results
+    buNN.results = {
+        'history': history,
+        'test_loss': test_loss,
+        'test_accuracy': test_accuracy,
+        'epoch_seconds': epoch_seconds
+    }
     return buNN
 
 # ---------------------------------------
 # Execute train_model() from command line
 # ---------------------------------------
-if args.data_dir:
+# The __main__ guard keeps DataLoader workers, which may re-import this file, from training again
+if __name__ == '__main__' and args.data_dir:
     train_model()
 
 # Testing load_model()
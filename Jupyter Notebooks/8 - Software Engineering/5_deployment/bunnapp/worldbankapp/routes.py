@@ -1,19 +1,13 @@
 from worldbankapp import app
-import json, plotly
 from flask import render_template
-from wrangling_scripts.wrangle_data import return_figures
+from wrangling_scripts.wrangle_data import return_figures_json
 
 @app.route('/')
 @app.route('/index')
 def index():
 
-    figures = return_figures()
-
-    # plot ids for the html id tag
-    ids = ['figure-{}'.format(i) for i, _ in enumerate(figures)]
-
-    # Convert the plotly figures to JSON for javascript in html template
-    figuresJSON = json.dumps(figures, cls=plotly.utils.PlotlyJSONEncoder)
+    # Figures and their JSON are only rebuilt when a data file changes
+    ids, figuresJSON = return_figures_json()
 
     return render_template('index.html',
                            ids=ids,
@@ -0,0 +1,140 @@
+import argparse
+import glob
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
+
+import pandas as pd
+
+DATA_DIR = 'data'
+STORE = os.path.join(DATA_DIR, 'worldbank.db')
+
+def data_files(data_dir=DATA_DIR):
+    """List the world bank csv files of the data directory
+
+    Args:
+        data_dir (str): directory of the API_*.csv files
+
+    Returns:
+        list (str): paths of the csv files
+
+    """
+    return sorted(glob.glob(os.path.join(data_dir, 'API_*.csv')))
+
+def tidy_data(dataset):
+    """Reshape a wide world bank csv file into one typed row per country and year
+
+    Args:
+        dataset (str): name of the csv data file
+
+    Returns:
+        DataFrame: indicator, country, country_code, row, year and value columns,
+            row being the position of the country in the csv file
+
+    """
+    df = pd.read_csv(dataset, skiprows=4)
+    years = [column for column in df.columns if column.isdigit()]
+
+    df = df[['Indicator Code', 'Country Name', 'Country Code'] + years]
+    df.columns = ['indicator', 'country', 'country_code'] + years
+    df['row'] = range(len(df))
+
+    df_melt = df.melt(id_vars=['indicator', 'country', 'country_code', 'row'], value_vars=years,
+                      var_name='year', value_name='value')
+    df_melt['year'] = df_melt['year'].astype('int64')
+    df_melt['value'] = df_melt['value'].astype('float64')
+
+    return df_melt
+
+def store_is_stale(data_dir=DATA_DIR, store=STORE):
+    """Check whether the store is missing, or older than the csv files it was built from
+
+    Args:
+        data_dir (str): directory of the API_*.csv files
+        store (str): path of the SQLite store
+
+    Returns:
+        bool: True if the csv files need to be ingested again
+
+    """
+    if not os.path.exists(store):
+        return True
+
+    try:
+        with closing(sqlite3.connect(store)) as conn:
+            ingested = dict(conn.execute('SELECT dataset, mtime FROM files').fetchall())
+    except sqlite3.Error:
+        return True
+
+    current = {dataset: os.path.getmtime(dataset) for dataset in data_files(data_dir)}
+    return ingested != current
+
+def ingest(data_dir=DATA_DIR, store=STORE):
+    """Convert all the world bank csv files into one indexed SQLite table, rebuilding the whole store
+
+    Args:
+        data_dir (str): directory of the API_*.csv files
+        store (str): path of the SQLite store
+
+    Returns:
+        None
+
+    """
+    # Build a new store beside the old one, then swap it in: readers never see a half-written store.
+    # Each process builds its own file, so processes ingesting at the same time can't corrupt each other's
+    fd, tmp_store = tempfile.mkstemp(dir=os.path.dirname(store) or '.', prefix=os.path.basename(store) + '.', suffix='.tmp')
+    os.close(fd)
+
+    try:
+        with closing(sqlite3.connect(tmp_store)) as conn:
+            conn.execute('CREATE TABLE files (dataset TEXT PRIMARY KEY, indicator TEXT, mtime REAL)')
+            conn.execute('CREATE TABLE indicators (indicator TEXT, country TEXT, country_code TEXT, '
+                         'row INTEGER, year INTEGER, value REAL)')
+
+            for dataset in data_files(data_dir):
+                mtime = os.path.getmtime(dataset)
+                df = tidy_data(dataset)
+                df.to_sql('indicators', conn, if_exists='append', index=False)
+                conn.execute('INSERT INTO files VALUES (?, ?, ?)', (dataset, df['indicator'].iloc[0], mtime))
+                print('Ingested {} rows of {}'.format(len(df), dataset))
+
+            conn.execute('CREATE INDEX indicator_country_year ON indicators (indicator, country, year)')
+            conn.commit()
+
+        os.replace(tmp_store, store)
+    finally:
+        if os.path.exists(tmp_store):
+            os.remove(tmp_store)
+
+def query_data(dataset, countries, years, store=STORE):
+    """Read the values of some countries and years of one csv file from the store
+
+    Args:
+        dataset (str): name of the ingested csv data file
+        countries (list): country names to keep
+        years (list): years to keep, as int or str
+
+    Returns:
+        DataFrame: country, year and value columns, ordered by year then csv row
+
+    """
+    countries = list(countries)
+    years = [int(year) for year in years]
+
+    # The WHERE clause runs on the (indicator, country, year) index, so only the requested rows are read
+    sql = ('SELECT country, year, value FROM indicators '
+           'WHERE indicator = (SELECT indicator FROM files WHERE dataset = ?) '
+           'AND country IN ({}) AND year IN ({}) '
+           'ORDER BY year, row').format(','.join('?' * len(countries)), ','.join('?' * len(years)))
+
+    with closing(sqlite3.connect(store)) as conn:
+        return pd.read_sql_query(sql, conn, params=[dataset] + countries + years)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest the world bank csv files into a SQLite store')
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR, help='Directory of the API_*.csv files')
+    parser.add_argument('--store', type=str, default=STORE, help='Path of the SQLite store')
+    args = parser.parse_args()
+
+    ingest(args.data_dir, args.store)
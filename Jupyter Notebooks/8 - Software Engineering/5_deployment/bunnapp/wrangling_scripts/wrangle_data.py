@@ -1,8 +1,61 @@
-import pandas as pd
+import json
+import os
+
+import plotly
 import plotly.graph_objs as go
 
+from wrangling_scripts.ingest_data import STORE, ingest, query_data, store_is_stale
+
 # TODO: Scroll down to line 157 and set up a fifth visualization for the data dashboard
 
+# The app reads the data from the SQLite store, never from the raw csv files. Each dyno builds its own
+# store here, at import, when it is missing or older than them: files written by a Heroku release or
+# one-off dyno never reach the web dynos. Concurrent workers each build in their own temporary file
+if store_is_stale():
+    ingest()
+
+# In-memory cache of the cleaned data frames and serialized figures.
+# Keys include the modification time of the store, so a new ingestion is read again
+_cache = {}
+
+def clear_cache():
+    """Empty the cache, so that the next request reads the store again
+
+    Args:
+        None
+
+    Returns:
+        None
+
+    """
+    _cache.clear()
+
+def refresh_store():
+    """Rebuild the whole store from all the csv files if any of them changed, and empty the cache
+
+    Args:
+        None
+
+    Returns:
+        None
+
+    """
+    if store_is_stale():
+        ingest()
+    clear_cache()
+
+def file_key(dataset):
+    """Identify a version of a data file by its path and modification time
+
+    Args:
+        dataset (str): name of the csv data file
+
+    Returns:
+        tuple: (path, modification time)
+
+    """
+    return (dataset, os.path.getmtime(dataset))
+
 def cleandata(dataset, keepcolumns = ['Country Name', '1990', '2015'], value_variables = ['1990', '2015']):
     """Clean world bank data for a visualizaiton dashboard
 
@@ -14,24 +67,56 @@ def cleandata(dataset, keepcolumns = ['Country Name', '1990', '2015'], value_var
         dataset (str): name of the csv data file
 
     Returns:
-        None
+        DataFrame: country, year and value columns, a copy the caller may modify
 
     """    
-    df = pd.read_csv(dataset, skiprows=4)
+    key = ('clean',) + file_key(STORE) + (dataset, tuple(keepcolumns), tuple(value_variables))
+    if key not in _cache:
+        top10country = ['United States', 'China', 'Japan', 'Germany', 'United Kingdom', 'India', 'France', 'Brazil', 'Italy', 'Canada']
+
+        # Only the top 10 economies and the years of interest are read from the store, already in long format
+        df = query_data(dataset, top10country, value_variables)
+        df.columns = ['country','year', 'variable']
+        _cache[key] = df
+
+    return _cache[key].copy()
 
-    # Keep only the columns of interest (years and country name)
-    df = df[keepcolumns]
+def country_traces(df, x, y, countrylist, mode='lines', text=None, **kwargs):
+    """Build one plotly scatter trace per country from a single groupby pass
 
-    top10country = ['United States', 'China', 'Japan', 'Germany', 'United Kingdom', 'India', 'France', 'Brazil', 'Italy', 'Canada']
-    df = df[df['Country Name'].isin(top10country)]
+    Args:
+        df (DataFrame): data with a country column
+        x (str): name of the column plotted on the x axis
+        y (str): name of the column plotted on the y axis
+        countrylist (list): countries to plot, in legend order
+        mode (str): plotly scatter mode
+        text (str): optional name of the column holding the hover text
+        **kwargs: any other go.Scatter attributes
 
-    # melt year columns  and convert year to date time
-    df_melt = df.melt(id_vars='Country Name', value_vars = value_variables)
-    df_melt.columns = ['country','year', 'variable']
-    df_melt['year'] = df_melt['year'].astype('datetime64[ns]').dt.year
+    Returns:
+        list (go.Scatter): one trace per country of countrylist
 
-    # output clean csv file
-    return df_melt
+    """
+    columns = [x, y] + ([text] if text else [])
+    groups = dict(list(df.groupby('country', sort=False)[columns]))
+    empty = df[columns].iloc[:0]
+
+    traces = []
+    for country in countrylist:
+        group = groups.get(country, empty)
+        if text:
+            kwargs['text'] = group[text].tolist()
+        traces.append(
+            go.Scatter(
+            x = group[x].tolist(),
+            y = group[y].tolist(),
+            mode = mode,
+            name = country,
+            **kwargs
+            )
+        )
+
+    return traces
 
 def return_figures():
     """Creates four plotly visualizations
@@ -47,23 +132,12 @@ def return_figures():
   # first chart plots arable land from 1990 to 2015 in top 10 economies 
   # as a line chart
     
-    graph_one = []
     df = cleandata('data/API_AG.LND.ARBL.HA.PC_DS2_en_csv_v2.csv')
     df.columns = ['country','year','hectaresarablelandperperson']
     df.sort_values('hectaresarablelandperperson', ascending=False, inplace=True)
     countrylist = df.country.unique().tolist()
     
-    for country in countrylist:
-      x_val = df[df['country'] == country].year.tolist()
-      y_val =  df[df['country'] == country].hectaresarablelandperperson.tolist()
-      graph_one.append(
-          go.Scatter(
-          x = x_val,
-          y = y_val,
-          mode = 'lines',
-          name = country
-          )
-      )
+    graph_one = country_traces(df, 'year', 'hectaresarablelandperperson', countrylist)
 
     layout_one = dict(title = 'Change in Hectares Arable Land <br> per Person 1990 to 2015',
                 xaxis = dict(title = 'Year',
@@ -92,21 +166,10 @@ def return_figures():
 
 
 # third chart plots percent of population that is rural from 1990 to 2015
-    graph_three = []
     df = cleandata('data/API_SP.RUR.TOTL.ZS_DS2_en_csv_v2_9948275.csv')
     df.columns = ['country', 'year', 'percentrural']
     df.sort_values('percentrural', ascending=False, inplace=True)
-    for country in countrylist:
-      x_val = df[df['country'] == country].year.tolist()
-      y_val =  df[df['country'] == country].percentrural.tolist()
-      graph_three.append(
-          go.Scatter(
-          x = x_val,
-          y = y_val,
-          mode = 'lines',
-          name = country
-          )
-      )
+    graph_three = country_traces(df, 'year', 'percentrural', countrylist)
 
     layout_three = dict(title = 'Change in Rural Population <br> (Percent of Total Population)',
                 xaxis = dict(title = 'Year',
@@ -115,7 +178,6 @@ def return_figures():
                 )
     
 # fourth chart shows rural population vs arable land
-    graph_four = []
     
     valuevariables = [str(x) for x in range(1995, 2016)]
     keepcolumns = [str(x) for x in range(1995, 2016)]
@@ -128,27 +190,9 @@ def return_figures():
     df_two.columns = ['country', 'year', 'variable']
     
     df = df_one.merge(df_two, on=['country', 'year'])
+    df['text'] = df['country'] + ' ' + df['year'].astype(str)    # hover labels for all the points at once
 
-    for country in countrylist:
-      x_val = df[df['country'] == country].variable_x.tolist()
-      y_val = df[df['country'] == country].variable_y.tolist()
-      year = df[df['country'] == country].year.tolist()
-      country_label = df[df['country'] == country].country.tolist()
-
-      text = []
-      for country, year in zip(country_label, year):
-          text.append(str(country) + ' ' + str(year))
-
-      graph_four.append(
-          go.Scatter(
-          x = x_val,
-          y = y_val,
-          mode = 'markers',
-          text = text,
-          name = country,
-          textposition = 'top'
-          )
-      )
+    graph_four = country_traces(df, 'variable_x', 'variable_y', countrylist, mode='markers', text='text', textposition='top')
 
     layout_four = dict(title = 'Rural Population versus <br> Forested Area (Square Km) 1990-2015',
                 xaxis = dict(title = 'Rural Population'),
@@ -180,4 +224,33 @@ def return_figures():
     figures.append(dict(data=graph_four, layout=layout_four))
     figures.append(dict(data=graph_five, layout=layout_five))
 
-    return figures
\ No newline at end of file
+    return figures
+
+def return_figures_json():
+    """Serialize the plotly visualizations once per version of the store
+
+    Args:
+        None
+
+    Returns:
+        ids (list): html ids of the figures
+        figuresJSON (str): the figures as JSON for javascript in the html template
+
+    """
+    key = ('figures',) + file_key(STORE)
+    if key not in _cache:
+        # Drop what was cached for older versions of the store
+        for old_key in [k for k in _cache if k[1:3] != file_key(STORE)]:
+            del _cache[old_key]
+
+        figures = return_figures()
+
+        # plot ids for the html id tag
+        ids = ['figure-{}'.format(i) for i, _ in enumerate(figures)]
+
+        # Convert the plotly figures to JSON for javascript in html template
+        figuresJSON = json.dumps(figures, cls=plotly.utils.PlotlyJSONEncoder)
+
+        _cache[key] = (ids, figuresJSON)
+
+    return _cache[key]
\ No newline at end of file